@@ -0,0 +1,26 @@
+# shared helpers for the simulated board CI scripts
+
+BENCH_BOARD="${BENCH_BOARD:-$(basename "$HOME")}"
+
+# sleep for the given number of seconds, +-25% jitter
+bench_sleep() {
+	awk -v base="${1:-0}" -v seed="$(od -An -N4 -tu4 /dev/urandom)" \
+		'BEGIN { srand(seed); printf "%.3f\n", base * (0.75 + rand() / 2) }' |
+		xargs sleep
+}
+
+# exit with an error at the rate given by $BENCH_FAILURE_RATE
+bench_maybe_fail() {
+	if awk -v rate="${BENCH_FAILURE_RATE:-0}" -v seed="$(od -An -N4 -tu4 /dev/urandom)" \
+		'BEGIN { srand(seed); exit !(rand() < rate) }'; then
+		echo "[$BENCH_BOARD] simulated $1 failure" >&2
+		exit 1
+	fi
+}
+
+# print some output, like the real test scripts do
+bench_output() {
+	for i in $(seq "${BENCH_OUTPUT_LINES:-20}"); do
+		echo "[$BENCH_BOARD] $1 step $i ok"
+	done
+}
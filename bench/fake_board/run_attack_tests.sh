@@ -0,0 +1,6 @@
+#!/usr/bin/env bash
+. "$(dirname "$0")/bench_lib.sh"
+
+bench_sleep "${BENCH_ATTACK_TIME:-5}"
+bench_output attack
+bench_maybe_fail attack
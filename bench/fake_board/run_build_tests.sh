@@ -0,0 +1,10 @@
+#!/usr/bin/env bash
+. "$(dirname "$0")/bench_lib.sh"
+
+[ -f ~/ectf2025/test_out/global.secrets ] || {
+	echo "run_build_tests.sh: missing global.secrets" >&2
+	exit 1
+}
+bench_sleep "${BENCH_TEST_TIME:-5}"
+bench_output test
+bench_maybe_fail test
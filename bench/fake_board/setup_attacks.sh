@@ -0,0 +1 @@
+# sourced before manual attack scripts, nothing to set up on a simulated board
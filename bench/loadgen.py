@@ -0,0 +1,255 @@
+"""
+Load generator for the build server protocol. Runs concurrent clients issuing
+build-ours and attack-target requests and reports throughput and per-stage latency.
+
+    python loadgen.py --port 8888 --token TOKEN --hash abc1234 --clients 4 --jobs 20
+"""
+
+import argparse
+import itertools
+import json
+import random
+import re
+import socket
+import statistics
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+
+# first line of output marking the start of each stage
+MARKERS = {
+    "build_start": (b"[BUILD] Pulling from repo",),
+    "build_end": (b"[BUILD] Built ",),
+    "dist_start": (b"[DIST] Uploading",),
+    "flash_start": (b"[DIST] Flashing binary",),
+    "flash_end": (b"[DIST] Flashed!",),
+    "run_start": (b"[TEST] Running tests on", b"[ATTACK] Running attacks for"),
+}
+
+RETRY_AFTER = re.compile(rb"Queue full, retry after (\d+) s")
+
+STAGES = (
+    "build_wait",
+    "build",
+    "dist_wait",
+    "upload",
+    "flash",
+    "prepare",
+    "run",
+    "total",
+)
+
+
+@dataclass
+class Result:
+    method: str
+    start: float
+    end: float = 0.0
+    code: int | None = None
+    times: dict[str, float] = field(default_factory=dict)
+    error: str | None = None
+    retry_after: int | None = None  # set if the server turned the request away
+
+    def stages(self) -> dict[str, float]:
+        """
+        Split the request into stages, skipping ones the server didn't report
+        :return: Stage name to duration in seconds
+        """
+        t = self.times
+        queued = t.get("build_end", self.start)
+        points: dict[str, tuple[float | None, float | None]] = {
+            "build_wait": (self.start, t.get("build_start")),
+            "build": (t.get("build_start"), t.get("build_end")),
+            "dist_wait": (queued, t.get("dist_start")),
+            "upload": (t.get("dist_start"), t.get("flash_start")),
+            "flash": (t.get("flash_start"), t.get("flash_end")),
+            "prepare": (t.get("flash_end"), t.get("run_start")),
+            "run": (t.get("run_start"), self.end),
+            "total": (self.start, self.end),
+        }
+        return {
+            name: end - start
+            for name, (start, end) in points.items()
+            if start is not None and end is not None and end >= start
+        }
+
+    @property
+    def queue_wait(self) -> float:
+        stages = self.stages()
+        return stages.get("build_wait", 0) + stages.get("dist_wait", 0)
+
+
+def request(host: str, port: int, token: str, method: str, payload: str) -> Result:
+    """
+    Issue one request and read its output until the final status
+    :return: The timings of the request
+    """
+    result = Result(method, time.time())
+    try:
+        with socket.create_connection((host, port), timeout=60 * 30) as sock:
+            sock.sendall(f"{token}|{method}".encode())
+            f = sock.makefile("rb")
+            # the server reads the payload with a separate recv, wait for it to answer
+            f.readline()
+            sock.sendall(payload.encode())
+            result.start = time.time()
+
+            for line in f:
+                now = time.time()
+                if match := RETRY_AFTER.search(line):
+                    result.retry_after = int(match[1])
+                for name, markers in MARKERS.items():
+                    if any(marker in line for marker in markers):
+                        result.times.setdefault(name, now)
+                if b"%*&" in line:
+                    result.code = int(line.split(b"%*&")[-1].strip() or b"-1")
+                    break
+    except (OSError, ValueError) as e:
+        result.error = str(e)
+    result.end = time.time()
+    return result
+
+
+def run_load(  # noqa: PLR0913, PLR0917
+    host: str,
+    port: int,
+    token: str,
+    hashes: list[str],
+    teams: list[str],
+    clients: int,
+    jobs: int,
+    attack_ratio: float,
+) -> tuple[list[Result], float]:
+    """
+    Run jobs requests spread over concurrent clients
+    :return: The results and the wall time taken
+    """
+    results: list[Result] = []
+    counter = itertools.count()
+    lock = threading.Lock()
+
+    def client():
+        while next(counter) < jobs:
+            if teams and (not hashes or random.random() < attack_ratio):
+                # forced, a cached result would be replayed without using a board
+                method, payload = "attack-target", f"{random.choice(teams)}|force"
+            else:
+                commit, run_id = random.choice(hashes), uuid.uuid4().hex[:12]
+                method, payload = "build-ours", f"{commit}|bench|benchmark|{run_id}"
+            # back off as told when the server is full
+            while (res := request(host, port, token, method, payload)).retry_after:
+                with lock:
+                    results.append(res)
+                time.sleep(res.retry_after)
+            with lock:
+                results.append(res)
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.time() - start
+
+
+def percentile(values: list[float], p: float) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[round(p) - 1]
+
+
+def summarize(results: list[Result], wall: float) -> dict:
+    rejected = [r for r in results if r.retry_after]
+    results = [r for r in results if not r.retry_after]
+    ok = [r for r in results if r.code == 0]
+    failed = [r for r in results if r.code != 0]
+
+    stages: dict[str, list[float]] = {name: [] for name in STAGES}
+    for r in ok:
+        for name, duration in r.stages().items():
+            stages[name].append(duration)
+    waits = [r.queue_wait for r in ok]
+
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "failed": len(failed),
+        "rejected": len(rejected),
+        "errors": sorted({r.error for r in failed if r.error}),
+        "wall_time": wall,
+        "jobs_per_hour": len(ok) / wall * 3600 if wall else 0,
+        "queue_wait": {
+            "mean": statistics.fmean(waits) if waits else 0,
+            "p95": percentile(waits, 95) if waits else 0,
+        },
+        "stages": {
+            name: {
+                "count": len(values),
+                "mean": statistics.fmean(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "max": max(values),
+            }
+            for name, values in stages.items()
+            if values
+        },
+    }
+
+
+def print_summary(summary: dict):
+    print(
+        f"{summary['succeeded']}/{summary['requests']} succeeded "
+        f"in {summary['wall_time']:.1f}s, {summary['jobs_per_hour']:.1f} jobs/hour"
+    )
+    if summary["rejected"]:
+        print(f"{summary['rejected']} requests turned away by admission control")
+    print(
+        f"queue wait: mean {summary['queue_wait']['mean']:.2f}s, "
+        f"p95 {summary['queue_wait']['p95']:.2f}s"
+    )
+    for error in summary["errors"]:
+        print(f"error: {error}")
+    print(f"{'stage':<12}{'count':>7}{'mean':>9}{'p50':>9}{'p95':>9}{'max':>9}")
+    for name, s in summary["stages"].items():
+        print(
+            f"{name:<12}{s['count']:>7}{s['mean']:>9.2f}{s['p50']:>9.2f}"
+            f"{s['p95']:>9.2f}{s['max']:>9.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--token", required=True)
+    parser.add_argument("--hash", action="append", default=[], dest="hashes")
+    parser.add_argument("--team", action="append", default=[], dest="teams")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--attack-ratio", type=float, default=0.0)
+    parser.add_argument("--json", action="store_true", help="print the summary as json")
+    args = parser.parse_args()
+    if not args.hashes and not args.teams:
+        parser.error("at least one --hash or --team is required")
+
+    results, wall = run_load(
+        args.host,
+        args.port,
+        args.token,
+        args.hashes,
+        args.teams,
+        args.clients,
+        args.jobs,
+        args.attack_ratio,
+    )
+    summary = summarize(results, wall)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+End-to-end throughput benchmark. Starts the build server against simulated boards
+and a stub design repo in a scratch directory, then drives it with the load
+generator and reports jobs/hour, queue wait and per-stage latency.
+
+    python bench/run_bench.py --boards 4 --attack-boards 2 --clients 8 --jobs 40
+
+Board latencies and failure rates are set with --flash-time, --test-time,
+--attack-time, --build-time and --failure-rate (see bench/fake_board). --transport
+picks how the server reaches the boards: through the ssh/rsync stand-ins in
+bench/bin, through the persistent agent on top of them, or as local processes.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from loadgen import print_summary, run_load, summarize
+
+BENCH = Path(__file__).resolve().parent
+SRC = BENCH.parent / "src"
+TOKEN = "bench"  # noqa: S105
+
+BUILD_SH = """#!/bin/sh
+sleep "${BENCH_BUILD_TIME:-1}"
+mkdir -p build_out
+head -c "${BENCH_FIRMWARE_SIZE:-131072}" /dev/urandom > build_out/max78000.bin
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git(*args: str, cwd: Path):
+    subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True)
+
+
+def make_design_repo(work: Path, commits: int) -> tuple[Path, list[str]]:
+    """
+    Create a stub design repo whose build.sh just sleeps and writes a firmware image
+    :param commits: How many distinct commits to create
+    :return: The repo to clone from and the commits to build
+    """
+    repo = work / "design-src"
+    (repo / "design").mkdir(parents=True)
+    (repo / "tools").mkdir()
+    (repo / "decoder").mkdir()
+    (repo / "design" / "README").write_text("stub design\n")
+    (repo / "tools" / "README").write_text("stub tools\n")
+    (repo / "build.sh").write_text(BUILD_SH)
+    (repo / "build.sh").chmod(0o755)
+    (repo / ".gitignore").write_text("build_out/\nsecrets/\n.venv/\n")
+
+    git("init", "-q", "-b", "main", cwd=repo)
+    hashes = []
+    for i in range(commits):
+        (repo / "design" / "VERSION").write_text(f"{i}\n")
+        git("add", "-A", cwd=repo)
+        git(
+            "-c", "user.name=bench", "-c", "user.email=bench@localhost",
+            "commit", "-q", "-m", f"stub design {i}",
+            cwd=repo,
+        )  # fmt: skip
+        hashes.append(
+            subprocess.run(
+                ["git", "rev-parse", "HEAD"],
+                cwd=repo,
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout.strip()
+        )
+    return repo, hashes
+
+
+def make_board(work: Path, name: str):
+    board = work / "boards" / name / "ectf2025"
+    shutil.copytree(BENCH / "fake_board", board / "CI")
+    # a checkout so the server can read the CI revision
+    git("init", "-q", cwd=board / "CI")
+    git("add", ".", cwd=board / "CI")
+    git(
+        "-c", "user.name=bench", "-c", "user.email=bench@localhost",
+        "commit", "-q", "-m", "stub CI",
+        cwd=board / "CI",
+    )  # fmt: skip
+    (board / ".venv" / "bin").mkdir(parents=True)
+    (board / ".venv" / "bin" / "activate").touch()
+    (board / "build_out").mkdir()
+    (board / "test_out").mkdir()
+
+
+def make_targets(work: Path, teams: int) -> list[str]:
+    names = []
+    for i in range(teams):
+        team = work / "home" / "mounts" / "targets" / f"team{i}"
+        (team / "design" / "design").mkdir(parents=True)
+        (team / "design" / "design" / "README").write_text("stub design\n")
+        (team / "attacker.prot").write_bytes(os.urandom(128 * 1024))
+        (team / "ports.txt").write_text("1 2 3\n")
+        names.append(team.name)
+    return names
+
+
+def write_config(work: Path, port: int, repo: Path, boards: list[tuple[str, str]]):
+    config = {
+        "AUTH_TOKEN": TOKEN,
+        "PORT": port,
+        "DEBUG": True,
+        "WEBHOOK_IP": "http://127.0.0.1:9/",
+        "DESIGN_REPO": str(repo),
+        "GITHUB_TOKEN": "",
+        "GITHUB_USERNAME": "",
+        "IPS": boards,
+    }
+    (work / "config.py").write_text(
+        "".join(f"{key} = {value!r}\n" for key, value in config.items())
+    )
+
+
+def wait_for_ready(port: int, server: subprocess.Popen, timeout: float):
+    """
+    Wait until the server has started its queues, so startup isn't counted as queue wait
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            sys.exit(f"server exited with {server.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1) as probe:
+                probe.sendall(f"{TOKEN}|status".encode())
+                f = probe.makefile("rb")
+                # the server reads the job id with a separate recv, wait for it to answer
+                f.readline()
+                probe.sendall(b"probe")
+                status = json.loads(f.readline())
+            if all(status["ready"].values()):
+                return
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.2)
+    sys.exit("server did not start")
+
+
+def main():  # noqa: PLR0915
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--boards", type=int, default=2, help="TEST boards")
+    parser.add_argument("--attack-boards", type=int, default=0, help="ATTACK boards")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--jobs", type=int, default=10)
+    parser.add_argument("--teams", type=int, default=4, help="attack targets")
+    parser.add_argument(
+        "--commits",
+        type=int,
+        default=4,
+        help="distinct commits to build, concurrent requests for one are deduplicated",
+    )
+    parser.add_argument("--attack-ratio", type=float, default=None)
+    parser.add_argument("--build-time", type=float, default=1)
+    parser.add_argument("--flash-time", type=float, default=2)
+    parser.add_argument("--test-time", type=float, default=5)
+    parser.add_argument("--attack-time", type=float, default=5)
+    parser.add_argument("--failure-rate", type=float, default=0)
+    parser.add_argument("--disconnect-rate", type=float, default=0)
+    parser.add_argument("--output-lines", type=int, default=20)
+    parser.add_argument(
+        "--transport",
+        choices=("ssh", "agent", "local"),
+        default="ssh",
+        help="board transport",
+    )
+    parser.add_argument("--keep", action="store_true", help="keep the scratch dir")
+    parser.add_argument("--json", action="store_true", help="print the summary as json")
+    args = parser.parse_args()
+    if args.attack_ratio is None:
+        args.attack_ratio = args.attack_boards / (args.boards + args.attack_boards)
+
+    work = Path(tempfile.mkdtemp(prefix="ectf-bench-"))
+    port = free_port()
+    repo, commits = make_design_repo(work, args.commits)
+    boards = [(f"bench@test{i}", "TEST") for i in range(args.boards)]
+    boards += [(f"bench@attack{i}", "ATTACK") for i in range(args.attack_boards)]
+    for ip, _ in boards:
+        make_board(work, ip.split("@")[1])
+    teams = make_targets(work, args.teams) if args.attack_boards else []
+    write_config(work, port, repo, boards)
+
+    env = {
+        **os.environ,
+        "PATH": f"{BENCH / 'bin'}{os.pathsep}{os.environ['PATH']}",
+        "PYTHONPATH": str(work),
+        "PYTHONUNBUFFERED": "1",
+        "HOME": str(work / "home"),
+        "BENCH_BOARDS": str(work / "boards"),
+        "BOARD_TRANSPORT": args.transport,
+        "LOCAL_BOARDS": str(work / "boards"),
+        "BENCH_BUILD_TIME": str(args.build_time),
+        "BENCH_FLASH_TIME": str(args.flash_time),
+        "BENCH_TEST_TIME": str(args.test_time),
+        "BENCH_ATTACK_TIME": str(args.attack_time),
+        "BENCH_FAILURE_RATE": str(args.failure_rate),
+        "BENCH_DISCONNECT_RATE": str(args.disconnect_rate),
+        "BENCH_OUTPUT_LINES": str(args.output_lines),
+    }
+    env.pop("DOCKER", None)
+
+    with open(work / "server.log", "wb") as log:
+        server = subprocess.Popen(
+            [sys.executable, str(SRC / "main.py")],
+            cwd=work,
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+    try:
+        wait_for_ready(port, server, timeout=120)
+        results, wall = run_load(
+            "127.0.0.1",
+            port,
+            TOKEN,
+            commits,
+            teams,
+            args.clients,
+            args.jobs,
+            args.attack_ratio,
+        )
+    finally:
+        server.terminate()
+        server.wait()
+
+    summary = summarize(results, wall)
+    summary["config"] = vars(args)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(
+            f"{args.boards} test boards, {args.attack_boards} attack boards, "
+            f"{args.clients} clients, {args.transport} transport"
+        )
+        print_summary(summary)
+
+    if args.keep:
+        print(f"scratch dir kept at {work}")
+    else:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import math
+import os
+
+import policy
+import state
+from log_channel import get_channel
+
+# jobs waiting for the builder or a board, each one holds a client socket
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", "64"))
+# queued or running jobs per commit author, or per target team for attacks
+MAX_JOBS_PER_AUTHOR = int(os.getenv("MAX_JOBS_PER_AUTHOR", "8"))
+DEFAULT_JOB_TIME = 60  # seconds a board takes per job before there are durations
+BOARD_STAGES = ("upload", "flash", "test")
+FINISHED = ("SUCCESS", "FAILED")
+
+
+def retry_after(excess: int, boards: int) -> int:
+    """
+    Estimate how long until excess jobs have left the boards
+    :param excess: How many jobs need to finish first
+    :param boards: Boards taking jobs
+    :return: Seconds to wait
+    """
+    typical = [policy.median(stage) for stage in BOARD_STAGES]
+    per_job = sum(t for t in typical if t is not None) or DEFAULT_JOB_TIME
+    return min(max(math.ceil(excess * per_job / max(boards, 1)), 5), 60 * 10)
+
+
+def admit(author: str) -> int | None:
+    """
+    Check if a new job fits within the queue limits. Must be called with state.lock
+    held until the job is queued, so concurrent requests can't overshoot.
+    :param author: The commit author, or the target team for attacks
+    :return: None if the job can be queued, otherwise seconds to wait before retrying
+    """
+    snapshot = state.snapshot()
+    waiting = [*snapshot["build"]["queue"], *snapshot["test"]["queue"]]
+    running = [
+        job
+        for job in (
+            snapshot["build"]["active"],
+            *(board["active"] for board in snapshot["test"]["activeTests"]),
+        )
+        if job and job["result"] not in FINISHED
+    ]
+    boards = sum(not board["locked"] for board in snapshot["test"]["activeTests"])
+
+    if len(waiting) >= MAX_QUEUED_JOBS:
+        return retry_after(len(waiting) - MAX_QUEUED_JOBS + 1, boards)
+    own = sum(
+        1
+        for job in waiting + running
+        if job["commit"] and job["commit"]["author"] == author
+    )
+    if own >= MAX_JOBS_PER_AUTHOR:
+        return retry_after(own - MAX_JOBS_PER_AUTHOR + 1, boards)
+    return None
+
+
+def job_status(job_id: str) -> dict:
+    """
+    Find a job in the queues, for clients polling instead of holding their connection
+    :param job_id: The job id
+    :return: Where the job is, state is QUEUED (with its position), RUNNING or DONE
+    """
+    snapshot = state.snapshot()
+    channel = get_channel(job_id)
+    status = {
+        "id": job_id,
+        # parts of the server still starting hold their queues
+        "ready": snapshot["ready"],
+        "state": "UNKNOWN" if channel is None else "RUNNING",
+        "result": None,
+        "position": None,
+        "code": None,
+        "output": 0 if channel is None else channel.size,
+    }
+    if channel is not None and channel.closed:
+        status.update(state="DONE", code=channel.code)
+        return status
+
+    for queue in (snapshot["build"]["queue"], snapshot["test"]["queue"]):
+        for position, job in enumerate(queue, 1):
+            if job["id"] == job_id:
+                status.update(state="QUEUED", result=job["result"], position=position)
+                return status
+    for job in (
+        snapshot["build"]["active"],
+        *(board["active"] for board in snapshot["test"]["activeTests"]),
+    ):
+        if job and job["id"] == job_id:
+            status.update(result=job["result"])
+    return status
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import BinaryIO
+
+from capture import Capture
+
+CACHE_DIR = Path("./attack_cache")
+MAX_ENTRIES = 256
+
+cache_lock = threading.Lock()
+
+
+@dataclass
+class CacheEntry:
+    key: str
+    team: str
+    revision: str  # CI revision of the board that ran the attacks
+    code: int
+    finished: float
+    last_used: float
+
+    @property
+    def path(self) -> Path:
+        return CACHE_DIR / f"{self.key}.log"
+
+
+@dataclass
+class AttackResult:
+    team: str
+    revision: str
+    code: int
+    finished: float
+    output: BinaryIO  # opened, so eviction can't remove it while it is read
+
+
+def result_key(target_digest: str, revision: str) -> str:
+    """
+    Get the cache key of an attack run
+    :param target_digest: The digest of the team's target folder
+    :param revision: The CI revision the attacks ran with
+    """
+    return hashlib.sha256(f"{target_digest}\0{revision}".encode()).hexdigest()
+
+
+def _load_index() -> dict[str, CacheEntry]:
+    try:
+        with open(CACHE_DIR / "index.json", encoding="utf-8") as f:
+            return {key: CacheEntry(**entry) for key, entry in json.load(f).items()}
+    except (OSError, ValueError, TypeError):
+        return {}
+
+
+def _save_index():
+    # replaced whole, a crash mid-write would orphan every cached result
+    tmp = CACHE_DIR / "index.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({key: asdict(entry) for key, entry in index.items()}, f)
+    os.replace(tmp, CACHE_DIR / "index.json")
+
+
+def _evict():
+    # drop least recently used results until under the limit
+    for entry in sorted(index.values(), key=lambda entry: entry.last_used)[
+        : max(len(index) - MAX_ENTRIES, 0)
+    ]:
+        entry.path.unlink(missing_ok=True)
+        del index[entry.key]
+
+
+def lookup(target_digest: str, revision: str) -> AttackResult | None:
+    """
+    Get the result of attacking an unchanged target with the same CI
+    :param target_digest: The digest of the team's target folder
+    :param revision: The CI revision on the attack boards
+    :return: The result, its output has to be closed. None if the attacks have to run
+    """
+    with cache_lock:
+        entry = index.get(result_key(target_digest, revision))
+        if entry is None:
+            return None
+        try:
+            output = open(entry.path, "rb")  # noqa: SIM115
+        except OSError:
+            del index[entry.key]
+            return None
+        entry.last_used = time.time()
+        _save_index()
+        return AttackResult(
+            entry.team, entry.revision, entry.code, entry.finished, output
+        )
+
+
+def store(target_digest: str, revision: str, team: str, code: int, output: Capture):
+    """
+    Cache the result of an attack run
+    :param target_digest: The digest of the team's target folder
+    :param revision: The CI revision the attacks ran with
+    :param team: The target team
+    :param code: The exit code sent to the client
+    :param output: The output of the attacks
+    """
+    now = time.time()
+    entry = CacheEntry(
+        result_key(target_digest, revision), team, revision, code, now, now
+    )
+    with cache_lock:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        output.save(entry.path)
+        index[entry.key] = entry
+        _evict()
+        _save_index()
+
+
+index: dict[str, CacheEntry] = _load_index()
@@ -0,0 +1,127 @@
+"""
+Board side of the persistent-agent transport. Started once per board over ssh, it
+reads framed requests on stdin and answers with framed responses on stdout, so
+every command after the first reuses the same connection.
+
+Frames are a type byte, a 4 byte big-endian payload length and the payload.
+Requests:
+    R   run a command, payload is json {"cmd", "timeout"}
+    U   upload, payload is a 4 byte json header length, json {"out_path"}, tar.gz
+    P   ping
+Responses:
+    O   output of the running command
+    X   done, payload is json {"code", "timed_out"}
+
+Only uses the standard library, the server copies it to the board on first use.
+"""
+
+import io
+import json
+import os
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import tarfile
+import threading
+from pathlib import Path
+
+HEADER = struct.Struct(">cI")
+READ_CHUNK = 64 * 1024  # longest output frame, lines past it are split
+
+
+def read_frame(f) -> tuple[bytes, bytes] | None:
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    kind, length = HEADER.unpack(header)
+    return kind, f.read(length)
+
+
+def write_frame(f, kind: bytes, payload: bytes):
+    f.write(HEADER.pack(kind, len(payload)) + payload)
+    f.flush()
+
+
+def done(out, code: int, *, timed_out: bool = False):
+    write_frame(out, b"X", json.dumps({"code": code, "timed_out": timed_out}).encode())
+
+
+def run(out, request: dict):
+    proc = subprocess.Popen(
+        ["bash", "-c", request["cmd"]],
+        cwd=Path.home(),
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+    )
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        os.killpg(proc.pid, signal.SIGKILL)
+
+    timer = threading.Timer(request["timeout"], kill)
+    timer.start()
+    try:
+        while line := proc.stdout.readline(READ_CHUNK):
+            write_frame(out, b"O", line)
+        code = proc.wait()
+    finally:
+        timer.cancel()
+    done(out, code, timed_out=timed_out.is_set())
+
+
+def clear(out_path: Path, tar: tarfile.TarFile):
+    """
+    Remove what the upload replaces, like rsync --delete, so files removed since
+    the last upload don't linger
+    """
+    for name in {Path(member.name).parts[0] for member in tar.getmembers()}:
+        if name in {".", ".."}:
+            continue
+        old = out_path / name
+        if old.is_dir() and not old.is_symlink():
+            shutil.rmtree(old)
+        elif old.exists() or old.is_symlink():
+            old.unlink()
+
+
+def upload(out, payload: bytes):
+    (length,) = struct.unpack(">I", payload[:4])
+    header = json.loads(payload[4 : 4 + length])
+    out_path = Path(os.path.expanduser(header["out_path"]))
+    try:
+        out_path.mkdir(parents=True, exist_ok=True)
+        with tarfile.open(fileobj=io.BytesIO(payload[4 + length :]), mode="r:gz") as tar:
+            clear(out_path, tar)
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(out_path, filter="data")
+            else:
+                tar.extractall(out_path)  # noqa: S202
+    except (OSError, tarfile.TarError) as e:
+        write_frame(out, b"O", f"upload failed: {e}\n".encode())
+        done(out, 1)
+        return
+    done(out, 0)
+
+
+def main():
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    while (frame := read_frame(stdin)) is not None:
+        kind, payload = frame
+        if kind == b"R":
+            run(stdout, json.loads(payload))
+        elif kind == b"U":
+            upload(stdout, payload)
+        elif kind == b"P":
+            done(stdout, 0)
+        else:
+            write_frame(stdout, b"O", f"unknown request {kind!r}\n".encode())
+            done(stdout, 1)
+
+
+if __name__ == "__main__":
+    main()
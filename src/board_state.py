@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+# what the server last left on each board, kept across restarts as the boards keep it
+STATE_FILE = Path("./board_state.json")
+
+lock = threading.Lock()
+
+
+def _load() -> dict[str, dict]:
+    try:
+        with open(STATE_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save():
+    tmp = STATE_FILE.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(boards, f)
+    os.replace(tmp, STATE_FILE)
+
+
+def digest(path: Path | str) -> str:
+    """
+    Hash a file, or a directory tree including its file names
+    :param path: The file or directory
+    :return: The hex digest
+    """
+    path = Path(path)
+    if path.is_file():
+        with open(path, "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
+
+    h = hashlib.sha256()
+    for file in sorted(p for p in path.rglob("*") if p.is_file()):
+        h.update(file.relative_to(path).as_posix().encode() + b"\0")
+        h.update(bytes.fromhex(digest(file)))
+    return h.hexdigest()
+
+
+def staged(ip: str, out_path: str) -> dict[str, str]:
+    """
+    Get what was last uploaded to out_path on a board
+    :return: Uploaded file or directory name to digest
+    """
+    with lock:
+        return dict(boards.get(ip, {}).get("staged", {}).get(out_path, {}))
+
+
+def record_staged(ip: str, out_path: str, digests: dict[str, str]):
+    """
+    Record a successful upload to out_path on a board
+    :param digests: Uploaded file or directory name to digest
+    """
+    with lock:
+        board = boards.setdefault(ip, {})
+        board.setdefault("staged", {}).setdefault(out_path, {}).update(digests)
+        _save()
+
+
+def forget_staged(ip: str, out_path: str):
+    """
+    Forget what is in out_path on a board, e.g. after a failed upload left it in an
+    unknown state
+    """
+    with lock:
+        boards.get(ip, {}).get("staged", {}).pop(out_path, None)
+        _save()
+
+
+def flashed(ip: str) -> str | None:
+    """
+    Get the image last flashed on a board
+    :return: The image digest and mode, None if unknown
+    """
+    with lock:
+        return boards.get(ip, {}).get("flashed")
+
+
+def record_flashed(ip: str, image: str | None):
+    """
+    Record the image flashed on a board
+    :param image: The image digest and mode, None if unknown
+    """
+    with lock:
+        boards.setdefault(ip, {})["flashed"] = image
+        _save()
+
+
+def ci_revision(ip: str) -> str | None:
+    """
+    Get the CI revision last seen on a board
+    :return: The commit hash, None if unknown
+    """
+    with lock:
+        return boards.get(ip, {}).get("ci")
+
+
+def record_ci_revision(ip: str, revision: str | None):
+    """
+    Record the CI revision checked out on a board
+    """
+    with lock:
+        boards.setdefault(ip, {})["ci"] = revision
+        _save()
+
+
+def forget(ip: str):
+    """
+    Forget everything about a board, e.g. after it disconnected or ran untrusted code
+    """
+    with lock:
+        boards.pop(ip, None)
+        _save()
+
+
+boards: dict[str, dict] = _load()
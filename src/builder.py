@@ -1,18 +1,33 @@
 import os
+import shutil
 import subprocess
 import sys
 import time
 import traceback
+from pathlib import Path
 from queue import Queue
 from threading import Thread
 
+import policy
+import profiling
+import startup
+import state
+from capture import Capture
 from colors import blue, red
 from config import DESIGN_REPO, GITHUB_TOKEN
 from distribution import TestingJob, add_to_dist_queue
 from jobs import BuildJob
+from transport import stream_process
 from webhook import push_webhook
 
+DESIGN_DIR = Path("2025-eCTF-design")
+# files in the design package that decide what pip installs
+PACKAGING_FILES = ("pyproject.toml", "setup.py", "setup.cfg", "requirements.txt")
+GH_HOSTS = Path(os.getenv("GH_CONFIG_DIR", "~/.config/gh")).expanduser() / "hosts.yml"
+
 BUILD_QUEUE: Queue[BuildJob] = Queue()
+# builds waiting in BUILD_QUEUE, guarded by state.lock
+pending_builds: list[BuildJob] = []
 active_build: BuildJob | None = None
 
 
@@ -21,14 +36,39 @@ def add_to_build_queue(job: BuildJob):
     Add a job to the build queue
     :param job: The job to add
     """
+    with state.lock:
+        pending_builds.append(job)
+        state.changed()
     BUILD_QUEUE.put(job)
 
 
-def build(job: BuildJob):
+def set_active_build(job: BuildJob | None):
     global active_build  # noqa: PLW0603
-    active_build = job
-    job.status = "BUILDING"
-    job.start_time = time.time()
+    with state.lock:
+        if job is not None:
+            pending_builds.remove(job)
+        active_build = job
+        state.changed()
+
+
+def run_step(job: BuildJob, command: str, timeout: float | None = None):
+    """
+    Run a build step in a shell, streaming its output to the job
+    :param job: The job
+    :param command: The shell command
+    :param timeout: Seconds before the step is killed
+    :raises subprocess.CalledProcessError: If the step failed, its output was sent
+    :raises subprocess.TimeoutExpired: If the step timed out
+    """
+    code = stream_process(command, timeout, job.send, shell=True)  # noqa: S604
+    if code != 0:
+        raise subprocess.CalledProcessError(code, command)
+
+
+def build(job: BuildJob):
+    profiling.record(job.channel, "build queue", job.start_time)
+    set_active_build(job)
+    job.set_status("BUILDING", time.time())
     push_webhook("BUILD", job)
 
     build_folder = f"./builds/{job.commit.run_id}"
@@ -37,25 +77,21 @@ def build(job: BuildJob):
         job.log(blue("[BUILD] Pulling from repo..."))
         # pull from repo
         try:
-            output = subprocess.run(
-                "cd 2025-eCTF-design &&"
-                "git checkout main &&"
-                "git fetch &&"
-                "git reset --hard origin/main &&"
-                f"git checkout {job.commit.hash}",
-                shell=True,
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            job.conn.sendall(output.stdout)
-            job.conn.sendall(output.stderr)
+            with profiling.span(job.channel, "git sync"):
+                run_step(
+                    job,
+                    "cd 2025-eCTF-design &&"
+                    "git checkout main &&"
+                    "git fetch &&"
+                    "git reset --hard origin/main &&"
+                    f"git checkout {job.commit.hash}",
+                )
         except subprocess.CalledProcessError as e:
             job.on_error(
                 e, f"[BUILD] Failed to build commit {job.commit.hash}! No commit found."
             )
 
-            job.status = "FAILED"
+            job.set_status("FAILED")
             push_webhook("BUILD", job)
             return
 
@@ -63,97 +99,102 @@ def build(job: BuildJob):
         # build secrets
         try:
             # todo: change active channels
-            output = subprocess.run(
-                "cd 2025-eCTF-design &&"
-                "rm -rf secrets/* &&"
-                "mkdir -p secrets &&"
-                ". ./.venv/bin/activate &&"
-                "pip install -e ./design &&"
-                "python -m ectf25_design.gen_secrets secrets/global.secrets 1 2 3 4",
-                shell=True,
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            job.conn.sendall(output.stdout)
-            job.conn.sendall(output.stderr)
+            with profiling.span(job.channel, "install design"):
+                run_step(
+                    job,
+                    "cd 2025-eCTF-design &&"
+                    ". ./.venv/bin/activate &&"
+                    "pip install -e ./design",
+                )
+            with profiling.span(job.channel, "gen secrets"):
+                run_step(
+                    job,
+                    "cd 2025-eCTF-design &&"
+                    "rm -rf secrets/* &&"
+                    "mkdir -p secrets &&"
+                    ". ./.venv/bin/activate &&"
+                    "python -m ectf25_design.gen_secrets secrets/global.secrets 1 2 3 4",
+                )
         except subprocess.CalledProcessError as e:
             job.on_error(
                 e,
                 f"[BUILD] Failed to build commit {job.commit.hash}! Failed to build secrets!",
             )
 
-            job.status = "FAILED"
+            job.set_status("FAILED")
             push_webhook("BUILD", job)
             return
 
         job.log(blue("[BUILD] Building decoder..."))
         # build decoder
         try:
-            if os.getenv("DOCKER"):
-                # docker-in-docker jank
-                # ectf_build_server_build_out is volume mounted to ~/mounts/build_out which is symlinked to ~/src/2025-eCTF-design/build_out
-                # ectf_build_server_decoder is volume mounted to ~/mounts/decoder which is copied from ~/src/2025-eCTF-design/decoder
-                # ectf_build_server_secrets is volume mounted to ~/mounts/secrets which is symlinked to ~/src/2025-eCTF-design/secrets
-                output = subprocess.run(
-                    "cd 2025-eCTF-design && "
-                    "cp -r decoder/* ~/mounts/decoder && rm -rf build_out/* &&"
-                    "(cd decoder && docker build -t decoder . && "
-                    "docker run --rm -v ectf_build_server_build_out:/out "
-                    "-v ectf_build_server_decoder:/decoder -v ectf_build_server_secrets:/secrets:ro "
-                    "-e DECODER_ID=0xdeadbeef -e LOCAL_SECRETS_FILE=/secrets/global.secrets decoder;) &&"
-                    '[ -n "$(ls -A build_out 2>/dev/null)" ]',
-                    shell=True,
-                    check=True,
-                    timeout=60 * 10,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                )
-            else:
-                output = subprocess.run(
-                    "cd 2025-eCTF-design && ./build.sh && "
-                    '[ -n "$(ls -A build_out 2>/dev/null)" ]',
-                    shell=True,
-                    check=True,
-                    timeout=60 * 10,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                )
-            job.conn.sendall(output.stdout)
-            job.conn.sendall(output.stderr)
+            with policy.timed("build") as timeout:
+                deadline = time.time() + timeout
+                if os.getenv("DOCKER"):
+                    # docker-in-docker jank
+                    # ectf_build_server_build_out is volume mounted to ~/mounts/build_out which is symlinked to ~/src/2025-eCTF-design/build_out
+                    # ectf_build_server_decoder is volume mounted to ~/mounts/decoder which is copied from ~/src/2025-eCTF-design/decoder
+                    # ectf_build_server_secrets is volume mounted to ~/mounts/secrets which is symlinked to ~/src/2025-eCTF-design/secrets
+                    with profiling.span(job.channel, "docker image"):
+                        run_step(
+                            job,
+                            "cd 2025-eCTF-design && "
+                            "cp -r decoder/* ~/mounts/decoder && rm -rf build_out/* &&"
+                            "cd decoder && docker build -t decoder .",
+                            timeout,
+                        )
+                    with profiling.span(job.channel, "compile firmware"):
+                        run_step(
+                            job,
+                            "cd 2025-eCTF-design && "
+                            "docker run --rm -v ectf_build_server_build_out:/out "
+                            "-v ectf_build_server_decoder:/decoder -v ectf_build_server_secrets:/secrets:ro "
+                            "-e DECODER_ID=0xdeadbeef -e LOCAL_SECRETS_FILE=/secrets/global.secrets decoder &&"
+                            '[ -n "$(ls -A build_out 2>/dev/null)" ]',
+                            max(deadline - time.time(), 0),
+                        )
+                else:
+                    with profiling.span(job.channel, "compile firmware"):
+                        run_step(
+                            job,
+                            "cd 2025-eCTF-design && ./build.sh && "
+                            '[ -n "$(ls -A build_out 2>/dev/null)" ]',
+                            timeout,
+                        )
         except subprocess.SubprocessError as e:
             job.on_error(
                 e, f"[BUILD] Failed to build commit {job.commit.hash}! Build failed!"
             )
 
-            job.status = "FAILED"
+            job.set_status("FAILED")
             push_webhook("BUILD", job)
             return
 
         # output in build_out
         try:
-            subprocess.run(
-                f"cp -Lr 2025-eCTF-design/ {build_folder}",
-                shell=True,
-                check=True,
-            )
+            with profiling.span(job.channel, "snapshot"):
+                subprocess.run(
+                    f"cp -Lr 2025-eCTF-design/ {build_folder}",
+                    shell=True,
+                    check=True,
+                )
         except subprocess.CalledProcessError as e:
             job.on_error(
                 e, f"[BUILD] Failed to build commit {job.commit.hash}! Build failed!"
             )
 
-            job.status = "FAILED"
+            job.set_status("FAILED")
             push_webhook("BUILD", job)
             return
 
         job.log(blue(f"[BUILD] Built {job.commit.hash}!"))
 
-        active_build = None
+        set_active_build(None)
         push_webhook()
 
         add_to_dist_queue(
             TestingJob(
-                job.conn,
+                job.channel,
                 "PENDING",
                 time.time(),
                 build_folder,
@@ -161,7 +202,7 @@ def build(job: BuildJob):
             )
         )
     finally:
-        active_build = None
+        set_active_build(None)
         BUILD_QUEUE.task_done()
 
 
@@ -170,12 +211,15 @@ def build_loop():
         job = BUILD_QUEUE.get()
         try:
             build(job)
-        except (BrokenPipeError, TimeoutError):
-            print(red("[BUILD] Client disconnected"))
-        except Exception:  # noqa: BLE001
+        except Exception as e:  # noqa: BLE001
             # error handling :tm:
+            job.on_error(e, f"[BUILD] Failed to build commit {job.commit.hash}!")
             push_webhook("BUILD", job)
-            traceback.print_exc()
+
+
+def remove_old_builds():
+    for old in Path(".").glob("builds.old-*"):
+        shutil.rmtree(old, ignore_errors=True)
 
 
 def init_build_queue():
@@ -183,8 +227,8 @@ def init_build_queue():
     Start the build queue
     """
 
-    # login into github
-    if (
+    # login into github, unless we already did with the same token
+    if not startup.unchanged("gh", startup.fingerprint(GITHUB_TOKEN, GH_HOSTS)) and (
         subprocess.run(
             ["gh", "auth", "status"],
             stdout=subprocess.PIPE,
@@ -213,6 +257,7 @@ def init_build_queue():
             print(red(traceback.format_exc()))
             sys.exit(1)
             return
+    startup.record("gh", startup.fingerprint(GITHUB_TOKEN, GH_HOSTS))
 
     # pull repo
     if (
@@ -243,28 +288,47 @@ def init_build_queue():
             check=True,
         )
 
-    # create venv
-    try:
-        subprocess.run(
-            "cd 2025-eCTF-design &&"
-            "python -m venv .venv --prompt ectf-example &&"
-            ". ./.venv/bin/activate &&"
-            "python -m pip install ./tools/ &&"
-            "python -m pip install -e ./design/",
-            shell=True,
-            timeout=60,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=True,
-        )
-    except subprocess.SubprocessError:
-        print(red("[BUILD] Failed to create venv!"))
-        print(traceback.format_exc())
-        sys.exit(1)
-        return
+    # create venv, unless the packages it installs are unchanged since it was created
+    venv_inputs = (
+        sys.version,
+        DESIGN_DIR / ".venv" / "bin" / "activate",
+        DESIGN_DIR / "tools",
+        *(DESIGN_DIR / "design" / name for name in PACKAGING_FILES),
+    )
+    if startup.unchanged("venv", startup.fingerprint(*venv_inputs)):
+        print("[BUILD] Reusing venv...")
+    else:
+        with Capture() as output:
+            try:
+                code = stream_process(  # noqa: S604
+                    "cd 2025-eCTF-design &&"
+                    "python -m venv .venv --prompt ectf-example &&"
+                    ". ./.venv/bin/activate &&"
+                    "python -m pip install ./tools/ &&"
+                    "python -m pip install -e ./design/",
+                    60,
+                    output.write,
+                    shell=True,
+                )
+                if code != 0:
+                    raise subprocess.CalledProcessError(code, "create venv")
+            except subprocess.SubprocessError:
+                print(red("[BUILD] Failed to create venv!"))
+                print(output.head_tail().decode(errors="replace"))
+                print(traceback.format_exc())
+                sys.exit(1)
+                return
+        # after installing, which may leave build files in the packages
+        startup.record("venv", startup.fingerprint(*venv_inputs))
 
-    subprocess.run(["rm", "-rf", "./builds"], check=True)
-    subprocess.run(["mkdir", "-p", "./builds"], check=True)
+    # build folders are unique per run, so old ones can be deleted while building
+    builds = Path("./builds")
+    if builds.exists():
+        builds.rename(f"./builds.old-{time.time_ns()}")
+    builds.mkdir()
+    Thread(target=remove_old_builds, daemon=True).start()
 
     print(blue("[BUILD] Build queue ready..."))
     Thread(target=build_loop, daemon=True).start()
+    state.set_ready("build")
+    push_webhook()
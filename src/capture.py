@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+from log_channel import LOG_DIR
+
+# output kept in memory per capture, past this it spills to a temporary file
+MEMORY_LIMIT = int(os.getenv("OUTPUT_MEMORY_LIMIT", "1048576"))
+# output of a failed command sent in error reports, split between its start and end
+REPORT_LIMIT = int(os.getenv("ERROR_OUTPUT_LIMIT", "65536"))
+COPY_CHUNK = 64 * 1024
+
+
+class Capture:
+    """
+    Output of a command, kept in memory up to MEMORY_LIMIT and on disk past it
+    """
+
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(MEMORY_LIMIT)  # noqa: SIM115
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, data: bytes):
+        """
+        Append output, can be used as an output callback
+        """
+        self.file.write(data)
+        self.size += len(data)
+
+    def read(self, offset: int, length: int) -> bytes:
+        self.file.seek(offset)
+        data = self.file.read(length)
+        self.file.seek(0, os.SEEK_END)
+        return data
+
+    def head_tail(self, limit: int = REPORT_LIMIT) -> bytes:
+        """
+        Get the output, with its middle left out if it is over limit
+        :param limit: The most bytes of output to return
+        :return: The output
+        """
+        if self.size <= limit:
+            return self.read(0, self.size)
+        half = limit // 2
+        return _elide(self.read(0, half), self.read(self.size - half, half), self.size)
+
+    def save(self, path: Path):
+        """
+        Copy the output to a file
+        """
+        self.file.seek(0)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(self.file, f, COPY_CHUNK)
+        self.file.seek(0, os.SEEK_END)
+
+    def close(self):
+        self.file.close()
+
+
+def _elide(head: bytes, tail: bytes, size: int) -> bytes:
+    omitted = size - len(head) - len(tail)
+    return head + f"\n[...] {omitted} bytes omitted [...]\n".encode() + tail
+
+
+def truncate(data: bytes, limit: int = REPORT_LIMIT) -> bytes:
+    """
+    Leave out the middle of output that is over limit
+    :param data: The output
+    :param limit: The most bytes of output to keep
+    :return: The output, with a marker where bytes were left out
+    """
+    if len(data) <= limit:
+        return data
+    half = limit // 2
+    return _elide(data[:half], data[len(data) - half :], len(data))
+
+
+def output_path(job_id: str) -> Path:
+    # pruned along with the job's log, see log_channel._prune
+    return LOG_DIR / f"{job_id}.output.log"
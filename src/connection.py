@@ -1,17 +1,42 @@
+import hashlib
+import json
 import re
 import socket
 import sys
+import threading
 import time
 import traceback
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
+import attack_cache
+import board_state
+import state
+from admission import admit, job_status
 from builder import add_to_build_queue
+from capture import output_path
 from colors import blue
 from config import AUTH_TOKEN, PORT
-from distribution import AttackingJob, AttackScriptJob, UpdateCIJob, add_to_dist_queue
-from jobs import BuildJob, CommitInfo
+from distribution import (
+    TARGETS_PATH,
+    AttackingJob,
+    AttackScriptJob,
+    UpdateCIJob,
+    add_to_dist_queue,
+    attack_revision,
+)
+from jobs import BuildJob, CommitInfo, Job
+from log_channel import READ_CHUNK, LogChannel, get_channel
+from profiling import trace_path
+from script_cache import ScriptFetchError, fetch_script, script_filename
 from webhook import push_webhook
 
+HANDSHAKE_WORKERS = 16
+
+# running jobs by request, guarded by state.lock
+inflight: dict[tuple[str, ...], Job] = {}
+
 
 # https://stackoverflow.com/a/52455972
 def is_url(url):
@@ -22,86 +47,289 @@ def is_url(url):
         return False
 
 
-def serve():
+def open_channel(conn: socket.socket) -> LogChannel:
+    """
+    Create the log channel of a new job, streaming to conn
+    :param conn: The client socket
+    :return: The channel
+    """
+    channel = LogChannel(conn)
+    # clients can use this to reattach if they get disconnected
+    channel.write(f"[CONN] Job id {channel.id}\n".encode())
+    return channel
+
+
+def reject(conn: socket.socket, retry_after: int):
+    """
+    Turn a client away because the queues are full
+    :param conn: The client socket
+    :param retry_after: Seconds the client should wait before retrying
+    """
+    msg = f"[CONN] Queue full, retry after {retry_after} s"
+    print(msg)
+    # plain, attack clients don't take colors
+    conn.sendall(msg.encode() + b"\n%*&1\n")
+    conn.close()
+
+
+def replay_cached_attack(conn: socket.socket, team: str) -> bool:
+    """
+    Answer an attack request from the cache if neither the target nor the CI changed
+    :param conn: The client socket
+    :param team: The target team
+    :return: Whether the request was answered
+    """
+    revision = attack_revision()
+    if revision is None:
+        return False
+    target = TARGETS_PATH / team
+    if not target.is_dir():
+        return False
+    result = attack_cache.lookup(board_state.digest(target), revision)
+    if result is None:
+        return False
+
+    print(blue(f"[ATTACK] Replaying cached attacks on {team}"))
+    channel = open_channel(conn)
+    finished = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(result.finished))
+    # attack clients get no colors, and the output was stored without them
+    channel.write(
+        f"[ATTACK] Target and CI unchanged, replaying result from {finished},"
+        f" send {team}|force to rerun\n".encode()
+    )
+    with result.output:
+        while chunk := result.output.read(READ_CHUNK):
+            channel.write(chunk)
+    channel.close(result.code)
+    return True
+
+
+def submit(
+    conn: socket.socket,
+    key: tuple[str, ...],
+    author: str,
+    make_job: Callable[[LogChannel], Job],
+    queue_job: Callable[[Job], None],
+):
+    """
+    Queue the job of a request. If an identical job is still running the client joins
+    it instead, getting the same output and final status.
+    :param conn: The client socket
+    :param key: What makes jobs identical, the method and its arguments
+    :param author: The commit author, or the target team for attacks
+    :param make_job: Creates the job on a channel
+    :param queue_job: Queues the job
+    """
+    # checked and queued under the lock so concurrent requests can't overshoot
+    with state.lock:
+        for key_done, job in list(inflight.items()):
+            if job.channel.closed or job.status == "FAILED":
+                del inflight[key_done]
+
+        job = inflight.get(key)
+        if job is not None:
+            msg = f"[CONN] Joining identical job {job.id}"
+            print(msg)
+            conn.sendall(msg.encode() + b"\n")
+            # replayed from the start, including the job id
+            job.channel.attach(conn)
+            return
+
+        retry_after = admit(author)
+        if retry_after is None:
+            job = make_job(open_channel(conn))
+            inflight[key] = job
+            queue_job(job)
+    if retry_after is not None:
+        reject(conn, retry_after)
+        return
+    push_webhook()
+
+
+def handle(conn: socket.socket, addr):
+    """
+    Read a request from a client and queue its job
+    :param conn: The client socket
+    :param addr: The client address
+    """
+    print(f"[CONN] New connection from {addr}")
+
+    try:
+        token, method = conn.recv(1024).decode().split("|")
+        if token != AUTH_TOKEN:
+            print("[CONN] Invalid connection, wrong token")
+            conn.close()
+            return
+
+        if method == "build-ours":
+            conn.sendall(b"[CONN] Building our design\n")
+            hash, author, name, run_id = conn.recv(1024).decode("utf-8").split("|")
+            print(f"[CONN] New build request for commit {hash}...")
+
+            if len(hash) > 40 or len(hash) < 7 or re.search(r"[^0-9a-f]", hash):
+                print(f"[CONN] Invalid hash {hash}")
+                conn.sendall(f"[CONN] Invalid hash {hash}\n".encode())
+                conn.close()
+                return
+
+            print(f"[CONN] Queuing build for commit {hash}...")
+            submit(
+                conn,
+                (method, hash),
+                author,
+                lambda channel: BuildJob(
+                    channel,
+                    "PENDING",
+                    time.time(),
+                    CommitInfo(hash, author, name, run_id),
+                ),
+                add_to_build_queue,
+            )
+        elif method == "attack-target":
+            conn.sendall(b"[CONN] Attacking target design\n")
+            # team, or team|force to rerun attacks whose result is cached
+            team, *flags = conn.recv(1024).decode("utf-8").split("|")
+
+            if "/" in team:
+                print(f"[CONN] Invalid team {team}")
+                conn.sendall(f"[CONN] Invalid team{team}\n".encode())
+                conn.close()
+                return
+
+            if "force" not in flags and replay_cached_attack(conn, team):
+                return
+
+            submit(
+                conn,
+                (method, team),
+                team,
+                lambda channel: AttackingJob(channel, "PENDING", time.time(), team),
+                add_to_dist_queue,
+            )
+        elif method == "attack-script":
+            conn.sendall(b"[CONN] Attacking target with manual attack script\n")
+            team, script_url = conn.recv(1024).decode("utf-8").split("|")
+
+            if not is_url(script_url):
+                # not security critical, just a sanity check
+                print(f"[CONN] Invalid script url {script_url}")
+                conn.sendall(f"[CONN] Invalid script url {script_url}\n".encode())
+                conn.close()
+                return
+
+            if not script_filename(script_url):
+                print(f"[CONN] Invalid script filename {script_url}")
+                conn.sendall(f"[CONN] Invalid script filename {script_url}\n".encode())
+                conn.close()
+                return
+
+            # don't fetch a script for a job that won't be queued
+            with state.lock:
+                retry_after = admit(team)
+            if retry_after is not None:
+                reject(conn, retry_after)
+                return
+
+            # fetch before queuing so a slow host never holds a board
+            conn.sendall(b"[CONN] Fetching attack script\n")
+            try:
+                script = fetch_script(script_url)
+            except ScriptFetchError as e:
+                print(f"[CONN] {e}")
+                conn.sendall(f"[CONN] {e}".encode() + b"\n%*&1\n")
+                conn.close()
+                return
+            if script.stale:
+                conn.sendall(b"[CONN] Could not revalidate script, using cached copy\n")
+
+            submit(
+                conn,
+                (method, team, hashlib.sha256(script.content).hexdigest()),
+                team,
+                lambda channel: AttackScriptJob(
+                    channel,
+                    "PENDING",
+                    time.time(),
+                    team,
+                    script,
+                ),
+                add_to_dist_queue,
+            )
+        elif method == "update-ci":
+            conn.sendall(b"[CONN] Updating CI\n")
+            job = UpdateCIJob(open_channel(conn), "PENDING", time.time())
+            # waits for the queues to drain, so it can't hold a handshake worker
+            threading.Thread(target=job.update_ci, daemon=True).start()
+        elif method == "reattach":
+            conn.sendall(b"[CONN] Reattaching to job\n")
+            job_id, offset = conn.recv(1024).decode("utf-8").split("|")
+
+            channel = get_channel(job_id)
+            if channel is None:
+                print(f"[CONN] Unknown job {job_id}")
+                conn.sendall(f"[CONN] Unknown job {job_id}\n".encode())
+                conn.close()
+                return
+
+            print(f"[CONN] Reattaching to job {job_id} at offset {offset}")
+            channel.attach(conn, max(int(offset), 0))
+        elif method == "status":
+            conn.sendall(b"[CONN] Getting job status\n")
+            job_id = conn.recv(1024).decode("utf-8")
+
+            # lets clients drop their connection while queued and poll instead
+            conn.sendall(json.dumps(job_status(job_id)).encode() + b"\n")
+            conn.close()
+        elif method == "trace":
+            conn.sendall(b"[CONN] Getting job trace\n")
+            job_id = conn.recv(1024).decode("utf-8")
+
+            # Chrome trace of a finished job's steps
+            path = trace_path(job_id)
+            if not re.fullmatch(r"[0-9a-f]+", job_id) or not path.is_file():
+                print(f"[CONN] No trace for job {job_id}")
+                conn.sendall(f"[CONN] No trace for job {job_id}\n".encode())
+                conn.close()
+                return
+
+            conn.sendall(path.read_bytes())
+            conn.close()
+        elif method == "output":
+            conn.sendall(b"[CONN] Getting job output\n")
+            job_id = conn.recv(1024).decode("utf-8")
+
+            # captured output of a failed upload, the log only has its head and tail
+            path = output_path(job_id)
+            if not re.fullmatch(r"[0-9a-f]+", job_id) or not path.is_file():
+                print(f"[CONN] No output for job {job_id}")
+                conn.sendall(f"[CONN] No output for job {job_id}\n".encode())
+                conn.close()
+                return
+
+            with open(path, "rb") as f:
+                conn.sendfile(f)
+            conn.close()
+    except Exception:  # noqa: BLE001
+        traceback.print_exc()
+        conn.close()
+
+
+def listen() -> socket.socket:
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # rebind right after a restart, without waiting out the old connections
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server.bind(("0.0.0.0", PORT))  # noqa: S104
     server.listen()
 
     print(blue(f"[CONN] Listening on port {PORT}..."))
     sys.stdout.flush()
+    return server
+
 
-    while True:
-        try:
+def serve(server: socket.socket):
+    # handshakes are short, a small pool keeps slow clients from blocking accept
+    with ThreadPoolExecutor(max_workers=HANDSHAKE_WORKERS) as pool:
+        while True:
             conn, addr = server.accept()
             conn.settimeout(10)
-            print(f"[CONN] New connection from {addr}")
-
-            try:
-                token, method = conn.recv(1024).decode().split("|")
-                if token != AUTH_TOKEN:
-                    print("[CONN] Invalid connection, wrong token")
-                    conn.close()
-                    continue
-
-                if method == "build-ours":
-                    conn.sendall(b"[CONN] Building our design\n")
-                    hash, author, name, run_id = (
-                        conn.recv(1024).decode("utf-8").split("|")
-                    )
-                    print(f"[CONN] New build request for commit {hash}...")
-
-                    if len(hash) > 40 or len(hash) < 7 or re.search(r"[^0-9a-f]", hash):
-                        print(f"[CONN] Invalid hash {hash}")
-                        conn.sendall(f"[CONN] Invalid hash {hash}\n".encode())
-                        conn.close()
-                        continue
-
-                    print(f"[CONN] Queuing build for commit {hash}...")
-
-                    req = BuildJob(
-                        conn,
-                        "PENDING",
-                        time.time(),
-                        CommitInfo(hash, author, name, run_id),
-                    )
-                    add_to_build_queue(req)
-                    push_webhook()
-                elif method == "attack-target":
-                    conn.sendall(b"[CONN] Attacking target design\n")
-                    team = conn.recv(1024).decode("utf-8")
-
-                    if "/" in team:
-                        print(f"[CONN] Invalid team {team}")
-                        conn.sendall(f"[CONN] Invalid team{team}\n".encode())
-                        conn.close()
-                        continue
-
-                    add_to_dist_queue(AttackingJob(conn, "PENDING", time.time(), team))
-                    push_webhook()
-                elif method == "attack-script":
-                    conn.sendall(b"[CONN] Attacking target with manual attack script\n")
-                    team, script_url = conn.recv(1024).decode("utf-8").split("|")
-
-                    if not is_url(script_url):
-                        # not security critical, just a sanity check
-                        print(f"[CONN] Invalid script url {script_url}")
-                        conn.sendall(f"[CONN] Invalid script url {script_url}\n".encode())
-                        conn.close()
-                        continue
-
-                    add_to_dist_queue(
-                        AttackScriptJob(conn, "PENDING", time.time(), team, script_url)
-                    )
-                    push_webhook()
-                elif method == "update-ci":
-                    conn.sendall(b"[CONN] Updating CI\n")
-                    UpdateCIJob(conn, "PENDING", time.time()).update_ci()
-
-            except Exception:  # noqa: BLE001
-                traceback.print_exc()
-                conn.close()
-                continue
-        except KeyboardInterrupt:
-            server.shutdown(socket.SHUT_RDWR)
-            server.close()
-            break
+            pool.submit(handle, conn, addr)
@@ -4,28 +4,41 @@ import subprocess
 import tempfile
 import threading
 import time
-from dataclasses import dataclass
+from collections import deque
+from collections.abc import Callable
+from dataclasses import dataclass, field
 from pathlib import Path
-from queue import Queue
-from socket import socket
 from typing import Literal
-from urllib.parse import urlparse
-
-import requests
 
+import attack_cache
+import board_state
+import policy
+import profiling
+import state
+from capture import Capture
 from colors import blue, red
 from config import GITHUB_TOKEN, GITHUB_USERNAME, IPS
-from jobs import CommitInfo, Job
+from jobs import ANSI_ESCAPE, CommitInfo, Job
+from log_channel import LogChannel
+from script_cache import Script
+from transport import transport
 from webhook import push_webhook
 
-distribution_queue: Queue["DistributionJob"] = Queue()
+distribution_queues: dict[str, deque["DistributionJob"]] = {
+    "TEST": deque(),
+    "ATTACK": deque(),
+}
 upload_status: dict[str, "UploadServerStatus"] = {}
-server_queues: dict[str, Queue[str]] = {"TEST": Queue(), "ATTACK": Queue()}
+# guards distribution_queues and upload_status, board workers wait on it for jobs
+dist_cond = threading.Condition(state.lock)
 
 OUT_PATH = "~/ectf2025/build_out/"
 TEST_OUT_PATH = "~/ectf2025/test_out/"
 CI_PATH = "~/ectf2025/CI/"
+TARGETS_PATH = Path("~/mounts/targets/").expanduser()
 VENV = ". ~/ectf2025/.venv/bin/activate"
+# written after a successful flash so the board can vouch for what it is running
+FLASH_MARKER = "~/ectf2025/flashed"
 
 
 @dataclass
@@ -35,17 +48,19 @@ class DistributionJob(Job):
     queue_type: Literal["ATTACK", "TEST"]
     attack_board: bool
     commit: CommitInfo | None = None
+    # boards the job hit a transient failure on, it is retried elsewhere if possible
+    failed_boards: set[str] = field(default_factory=set)
 
     def to_json(self):
         return {
+            "id": self.id,
             "result": self.status,
             "actionStart": round(self.start_time),
             "commit": self.commit and self.commit.to_json(),
         }
 
     def distribute(self, ip: str):
-        self.status = "UPLOADING"
-        self.start_time = time.time()
+        self.set_status("UPLOADING", time.time())
         push_webhook(self.queue_type, self)
 
         firmware_file = Path(self.in_path).name
@@ -53,96 +68,134 @@ class DistributionJob(Job):
             # upload to server
             self.log(blue(f"[DIST] Uploading {self.name} to {ip}"))
             try:
-                self.upload(ip, [self.in_path], OUT_PATH)
+                with profiling.span(self.channel, "upload firmware", ip):
+                    self.upload(ip, [self.in_path], OUT_PATH)
             except subprocess.SubprocessError as e:
-                if (
-                    isinstance(e, subprocess.CalledProcessError)
-                    and b"Connection closed by UNKNOWN port 65535" in e.stderr
-                ):
-                    self.log(f"[DIST] {ip} is disconnected, changing servers")
-
-                    self.status = "PENDING"
-                    push_webhook(self.queue_type, self)
-
-                    upload_status[ip].connected = False
-                    add_to_dist_queue(self)
-                else:
-                    self.on_error(e, f"[DIST] Failed to upload to {ip}")
-
-                    self.status = "FAILED"
-                    push_webhook(self.queue_type, self)
+                self.fail(ip, e, "upload", f"[DIST] Failed to upload to {ip}")
                 return
 
-            # flash binary
-            self.log(blue("[DIST] Flashing binary"))
-            try:
-                output = subprocess.run(
-                    [
-                        "ssh",
-                        "-F",
-                        "ssh_config",
-                        "-i",
-                        "id_ed25519",
-                        "-o",
-                        "StrictHostKeyChecking=accept-new",
-                        ip,
-                        f"{VENV} || exit 1; {CI_PATH}/update {OUT_PATH}/{firmware_file} {'1' if self.attack_board else ''};",
-                    ],
-                    timeout=60 * 4,
-                    check=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
+            # flash binary, unless the board is already running it
+            mode = "attack" if self.attack_board else "test"
+            image = f"{board_state.digest(self.in_path)} {mode}"
+            if self.is_flashed(ip, image):
+                self.log(
+                    blue(f"[DIST] {ip} is already running {self.name}, not flashing")
                 )
-                self.conn.sendall(output.stdout)
-                self.conn.sendall(output.stderr)
-            except subprocess.SubprocessError as e:
-                self.on_error(e, f"[DIST] Failed to flash on {ip}")
-
-                self.status = "FAILED"
-                push_webhook(self.queue_type, self)
-                return
+            else:
+                self.log(blue("[DIST] Flashing binary"))
+                board_state.record_flashed(ip, None)
+                try:
+                    with (
+                        policy.timed("flash", ip) as timeout,
+                        profiling.span(self.channel, "flash", ip),
+                    ):
+                        transport.run(
+                            ip,
+                            f"{VENV} || exit 1; "
+                            f"rm -f {FLASH_MARKER}; "
+                            f"{CI_PATH}/update {OUT_PATH}/{firmware_file} "
+                            f"{'1' if self.attack_board else ''} && "
+                            f"echo '{image}' > {FLASH_MARKER};",
+                            timeout,
+                            self.send,
+                        )
+                except subprocess.SubprocessError as e:
+                    self.fail(ip, e, "flash", f"[DIST] Failed to flash on {ip}")
+                    return
 
-            self.log(blue("[DIST] Flashed!"))
+                board_state.record_flashed(ip, image)
+                self.log(blue("[DIST] Flashed!"))
             self.post_upload(ip)
-        except (BrokenPipeError, TimeoutError):
-            print(red("[DIST] Client disconnected"))
         finally:
-            if upload_status[ip].connected:
-                # if not changing servers
-                server_queues[self.queue_type].put(ip)
+            if self.status == "PENDING":
+                # changing servers, requeue only now so no other board starts on it
+                # before we are done with it
+                add_to_dist_queue(self)
+            else:
                 self.cleanup()
-            distribution_queue.task_done()
+
+    def fail(self, ip: str, e: subprocess.SubprocessError, stage: str, msg: str):
+        """
+        Fail the job, or put it back to be picked up by another board if the board
+        was at fault
+        :param ip: The board the job failed on
+        :param e: The error
+        :param stage: The stage that failed, one of policy.STAGES
+        :param msg: The message to log
+        """
+        kind = policy.classify(e, stage)
+        # a dropped connection doesn't mean the board is gone, only move the job
+        if kind == policy.DISCONNECTED and transport.check(ip):
+            kind = policy.TRANSIENT
+        if kind == policy.DISCONNECTED:
+            self.log(f"[DIST] {ip} is disconnected, changing servers")
+            # it may come back reflashed or wiped
+            board_state.forget(ip)
+
+            with dist_cond:
+                upload_status[ip].connected = False
+                state.changed()
+                dist_cond.notify_all()
+        elif kind == policy.TRANSIENT and len(self.failed_boards) < policy.MAX_MOVES:
+            self.log(red(f"{msg}, retrying on another board"))
+            self.failed_boards.add(ip)
+        else:
+            self.on_error(e, msg)
+
+            self.set_status("FAILED")
+            push_webhook(self.queue_type, self)
+            return
+
+        self.set_status("PENDING")
+        push_webhook(self.queue_type, self)
+
+    def is_flashed(self, ip: str, image: str) -> bool:
+        """
+        Check if a board is running an image, both by our records and by the marker
+        left on the board when it was flashed
+        :param ip: The board
+        :param image: The image digest and mode
+        """
+        if board_state.flashed(ip) != image:
+            return False
+        marker = bytearray()
+        try:
+            transport.run(ip, f"cat {FLASH_MARKER}", 30, marker.extend)
+        except subprocess.SubprocessError:
+            return False
+        return marker.decode(errors="replace").strip() == image
 
     def upload(self, ip: str, files: list[Path | str], out_path: str):
-        # auto-retry to work around PAL
+        # only send what changed since the last upload to this board
+        digests = {Path(file).name: board_state.digest(file) for file in files}
+        staged = board_state.staged(ip, out_path)
+        skipped = [name for name, digest in digests.items() if staged.get(name) == digest]
+        changed = [file for file in files if Path(file).name not in skipped]
+        if skipped:
+            self.log(
+                blue(f"[DIST] {', '.join(skipped)} unchanged on {ip}, not uploading")
+            )
+        if not changed:
+            return
+
+        # auto-retry to work around PAL, retries resume from the partial transfer
         max_retries = 3
         for i in range(max_retries):
             try:
-                subprocess.run(
-                    [
-                        "rsync",
-                        (
-                            "--rsh=ssh -F ssh_config -i id_ed25519 -o StrictHostKeyChecking=accept-new"
-                            " -o ServerAliveInterval=5 -o ServerAliveCountMax=1"
-                        ),
-                        "-av",
-                        "--partial",
-                        "--progress",
-                        "--delete",
-                        *files,
-                        f"{ip}:{out_path}",
-                    ],
-                    timeout=30,
-                    check=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                )
-            except subprocess.CalledProcessError as e:
-                if i == max_retries - 1:
-                    raise
-                if b"write error: Broken pipe" not in e.stderr:
+                with policy.timed("upload", ip) as timeout:
+                    transport.upload(ip, changed, out_path, timeout)
+                break
+            except subprocess.SubprocessError as e:
+                transient = policy.classify(e, "upload") == policy.TRANSIENT
+                if i == max_retries - 1 or not transient:
+                    # a partial upload leaves the board in an unknown state
+                    board_state.forget_staged(ip, out_path)
                     raise
 
+        board_state.record_staged(
+            ip, out_path, {Path(file).name: digests[Path(file).name] for file in changed}
+        )
+
     def cleanup(self):
         pass
 
@@ -153,7 +206,7 @@ class DistributionJob(Job):
 class TestingJob(DistributionJob):
     def __init__(
         self,
-        conn: socket,
+        channel: LogChannel,
         status: str,
         start_time: float,
         build_folder: str,
@@ -161,7 +214,7 @@ class TestingJob(DistributionJob):
     ):
         self.build_folder = build_folder
         super().__init__(
-            conn=conn,
+            channel=channel,
             status=status,
             start_time=start_time,
             name=commit.hash,
@@ -173,7 +226,7 @@ class TestingJob(DistributionJob):
         )
 
     def post_upload(self, ip: str):
-        self.status = "TESTING"
+        self.set_status("TESTING")
         push_webhook("TEST", self)
 
         # run tests
@@ -182,55 +235,40 @@ class TestingJob(DistributionJob):
         # upload test data to server
         self.log(blue(f"[TEST] Uploading test data to {ip}"))
         try:
-            self.upload(
-                ip,
-                [
-                    f"{self.build_folder}/design",
-                    f"{self.build_folder}/secrets/global.secrets",
-                ],
-                TEST_OUT_PATH,
-            )
+            with profiling.span(self.channel, "upload test data", ip):
+                self.upload(
+                    ip,
+                    [
+                        f"{self.build_folder}/design",
+                        f"{self.build_folder}/secrets/global.secrets",
+                    ],
+                    TEST_OUT_PATH,
+                )
         except subprocess.SubprocessError as e:
-            self.on_error(e, f"[TEST] Failed to upload to {ip}")
-
-            self.status = "FAILED"
-            push_webhook("TEST", self)
+            self.fail(ip, e, "upload", f"[TEST] Failed to upload to {ip}")
             return
 
         self.log(blue(f"[TEST] Running tests on {ip}"))
 
         try:
-            output = subprocess.run(
-                [
-                    "ssh",
-                    "-F",
-                    "ssh_config",
-                    "-i",
-                    "id_ed25519",
-                    "-o",
-                    "StrictHostKeyChecking=accept-new",
+            with (
+                policy.timed("test", ip) as timeout,
+                profiling.span(self.channel, "tests", ip),
+            ):
+                transport.run(
                     ip,
                     f"{VENV} || exit 1; {CI_PATH}/run_build_tests.sh;",
-                ],
-                timeout=60 * 10,
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            self.conn.sendall(output.stdout)
-            self.conn.sendall(output.stderr)
+                    timeout,
+                    self.send,
+                )
 
         except subprocess.SubprocessError as e:
-            self.on_error(e, f"[TEST] Tests failed for {self.name}")
-
-            self.status = "FAILED"
-            push_webhook("TEST", self)
+            self.fail(ip, e, "test", f"[TEST] Tests failed for {self.name}")
             return
 
         self.log(blue(f"[TEST] Tests OK for {self.name}"))
-        self.conn.sendall(b"%*&0\n")
-        self.conn.close()
-        self.status = "SUCCESS"
+        self.finish(0)
+        self.set_status("SUCCESS")
         push_webhook("TEST", self)
 
     def cleanup(self):
@@ -240,15 +278,15 @@ class TestingJob(DistributionJob):
 class AttackingJob(DistributionJob):
     def __init__(
         self,
-        conn: socket,
+        channel: LogChannel,
         status: str,
         start_time: float,
         team: str,
     ):
         self.team = team
-        self.target_folder = Path("~/mounts/targets/").expanduser() / team
+        self.target_folder = TARGETS_PATH / team
         super().__init__(
-            conn=conn,
+            channel=channel,
             status=status,
             start_time=start_time,
             name=team,
@@ -260,7 +298,7 @@ class AttackingJob(DistributionJob):
         )
 
     def post_upload(self, ip: str):
-        self.status = "ATTACKING"
+        self.set_status("ATTACKING")
         push_webhook("ATTACK", self)
 
         # upload attack data to server
@@ -272,72 +310,75 @@ class AttackingJob(DistributionJob):
                 for p in self.target_folder.iterdir()
                 if p.is_file() and p.suffix != ".prot"
             ]
-            self.upload(
-                ip,
-                [
-                    *target_files,
-                    self.target_folder / "design/design",
-                ],
-                TEST_OUT_PATH,
-            )
+            with profiling.span(self.channel, "upload attack data", ip):
+                self.upload(
+                    ip,
+                    [
+                        *target_files,
+                        self.target_folder / "design/design",
+                    ],
+                    TEST_OUT_PATH,
+                )
         except subprocess.SubprocessError as e:
-            self.on_error(e, f"[ATTACK] Failed to upload to {ip}")
-
-            self.status = "FAILED"
-            push_webhook("ATTACK", self)
+            self.fail(ip, e, "upload", f"[ATTACK] Failed to upload to {ip}")
             return
 
-        # run attacks
+        # run attacks, keeping the output to answer repeats of this run from the cache
         self.log(blue(f"[ATTACK] Running attacks for {self.name} on {ip}"))
+        target_digest = board_state.digest(self.target_folder)
+        revision = ci_revision(ip)
 
-        try:
-            output = subprocess.run(
-                [
-                    "ssh",
-                    "-F",
-                    "ssh_config",
-                    "-i",
-                    "id_ed25519",
-                    "-o",
-                    "StrictHostKeyChecking=accept-new",
-                    ip,
-                    f"{VENV} || exit 1; {CI_PATH}/run_attack_tests.sh 1;",
-                ],
-                timeout=60 * 10,
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            self.conn.sendall(output.stdout)
-            self.conn.sendall(output.stderr)
-        except subprocess.SubprocessError as e:
-            self.on_error(e, f"[ATTACK] Attacks failed for {self.name}")
+        def on_output(line: bytes):
+            # stored as attack clients get it, without colors
+            output.write(ANSI_ESCAPE.sub(b"", line))
+            self.send(line)
 
-            self.status = "FAILED"
-            push_webhook("ATTACK", self)
-            return
+        with Capture() as output:
+            try:
+                with (
+                    policy.timed("attack", ip) as timeout,
+                    profiling.span(self.channel, "attacks", ip),
+                ):
+                    transport.run(
+                        ip,
+                        f"{VENV} || exit 1; {CI_PATH}/run_attack_tests.sh 1;",
+                        timeout,
+                        on_output,
+                    )
+            except subprocess.SubprocessError as e:
+                # only the attacks failing is a result, not the board or a timeout
+                if (
+                    revision is not None
+                    and isinstance(e, subprocess.CalledProcessError)
+                    and policy.classify(e, "attack") == policy.FATAL
+                ):
+                    attack_cache.store(target_digest, revision, self.team, 1, output)
+                self.fail(ip, e, "attack", f"[ATTACK] Attacks failed for {self.name}")
+                return
+
+            if revision is not None:
+                attack_cache.store(target_digest, revision, self.team, 0, output)
 
         self.log(blue(f"[ATTACK] ATTACK OK for {self.name}"))
-        self.conn.sendall(b"%*&0\n")
-        self.conn.close()
-        self.status = "SUCCESS"
+        self.finish(0)
+        self.set_status("SUCCESS")
         push_webhook("ATTACK", self)
 
 
 class AttackScriptJob(DistributionJob):
     def __init__(
         self,
-        conn: socket,
+        channel: LogChannel,
         status: str,
         start_time: float,
         team: str,
-        script_url: str,
+        script: Script,
     ):
         self.team = team
-        self.target_folder = Path("~/mounts/targets/").expanduser() / team
-        self.script_url = script_url
+        self.target_folder = TARGETS_PATH / team
+        self.script = script
         super().__init__(
-            conn=conn,
+            channel=channel,
             status=status,
             start_time=start_time,
             name=team,
@@ -349,202 +390,297 @@ class AttackScriptJob(DistributionJob):
         )
 
     def post_upload(self, ip: str):
-        self.status = "ATTACKING"
+        self.set_status("ATTACKING")
         push_webhook("ATTACK", self)
 
-        # download attack script
-        self.log(blue("[ATTACK] Downloading attack script"))
-        try:
-            resp = requests.get(self.script_url, timeout=5)
-            if not resp.ok:
-                self.log(
-                    red(
-                        f"[ATTACK] Fetching {self.script_url} returned {resp.status_code}"
-                    )
-                )
-                self.status = "FAILED"
-                push_webhook("ATTACK", self)
-                return
-
-            script_filename = urlparse(self.script_url).path.split("/")[-1]
-
-            if "/" in script_filename:
-                self.log(red(f"[ATTACK] Invalid filename {script_filename}"))
-                self.status = "FAILED"
-                push_webhook("ATTACK", self)
-                return
-        except requests.Timeout as e:
-            self.on_error(e, f"[ATTACK] Failed to upload to {ip}")
-
-            self.status = "FAILED"
-            push_webhook("ATTACK", self)
-            return
-
         # upload attack data to server
         self.log(blue(f"[ATTACK] Uploading attack data to {ip}"))
 
         try:
             with tempfile.TemporaryDirectory() as temp_dir:
-                script_path = Path(temp_dir) / script_filename
-                with script_path.open("w") as f:
-                    f.write(resp.text)
+                script_path = Path(temp_dir) / self.script.filename
+                script_path.write_bytes(self.script.content)
                 target_files = [
                     p
                     for p in self.target_folder.iterdir()
                     if p.is_file() and p.suffix != ".prot"
                 ]
-                self.upload(
-                    ip,
-                    [
-                        *target_files,
-                        self.target_folder / "design/design",
-                        script_path,
-                    ],
-                    TEST_OUT_PATH,
-                )
+                with profiling.span(self.channel, "upload attack data", ip):
+                    self.upload(
+                        ip,
+                        [
+                            *target_files,
+                            self.target_folder / "design/design",
+                            script_path,
+                        ],
+                        TEST_OUT_PATH,
+                    )
         except subprocess.SubprocessError as e:
-            self.on_error(e, f"[ATTACK] Failed to upload to {ip}")
-
-            self.status = "FAILED"
-            push_webhook("ATTACK", self)
+            self.fail(ip, e, "upload", f"[ATTACK] Failed to upload to {ip}")
             return
 
         # run attack
         self.log(blue(f"[ATTACK] Running attack script for {self.name} on {ip}"))
+        # the script may reflash the board or change its files
+        board_state.forget(ip)
 
         try:
-            remote_script_path = Path(TEST_OUT_PATH) / script_filename
+            remote_script_path = Path(TEST_OUT_PATH) / self.script.filename
             # ensure that ~ in TEST_OUT_PATH is still expanded
-            quoted_script_path = f"{TEST_OUT_PATH}/{shlex.quote(script_filename)}"
+            quoted_script_path = f"{TEST_OUT_PATH}/{shlex.quote(self.script.filename)}"
             command = (
                 f"python3 {quoted_script_path}"
                 if remote_script_path.suffix == ".py"
                 else f"chmod +x {quoted_script_path}; {quoted_script_path}"
             )
-            output = subprocess.run(
-                [
-                    "ssh",
-                    "-F",
-                    "ssh_config",
-                    "-i",
-                    "id_ed25519",
-                    "-o",
-                    "StrictHostKeyChecking=accept-new",
+            with (
+                policy.timed("attack_script", ip) as timeout,
+                profiling.span(self.channel, "attack script", ip),
+            ):
+                transport.run(
                     ip,
                     (
                         f"{VENV} || exit 1;"
                         f"cd {TEST_OUT_PATH}; . {CI_PATH}/setup_attacks.sh;"
                         f"echo Running attack; {command} 2>&1"
                     ),
-                ],
-                timeout=60 * 10,
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            self.conn.sendall(output.stdout)
-            self.conn.sendall(output.stderr)
+                    timeout,
+                    self.send,
+                )
         except subprocess.SubprocessError as e:
-            self.on_error(e, f"[ATTACK] Attacks failed for {self.name}")
-
-            self.status = "FAILED"
-            push_webhook("ATTACK", self)
+            self.fail(ip, e, "attack_script", f"[ATTACK] Attacks failed for {self.name}")
             return
 
         self.log(blue(f"[ATTACK] ATTACK OK for {self.name}"))
-        self.conn.sendall(b"%*&0\n")
-        self.conn.close()
-        self.status = "SUCCESS"
+        self.finish(0)
+        self.set_status("SUCCESS")
         push_webhook("ATTACK", self)
 
 
 class UpdateCIJob(Job):
-    def __init__(self, conn, status, start_time):
-        super().__init__(conn, status, start_time, socket_colors=True)
+    def __init__(self, channel, status, start_time):
+        self.results: dict[str, str] = {}
+        super().__init__(channel, status, start_time, socket_colors=True)
 
     def update_ci(self):
-        from builder import BUILD_QUEUE  # noqa: PLC0415
-
-        BUILD_QUEUE.join()
-        distribution_queue.join()
-
-        for ip, status in upload_status.items():
-            if status.connected:
-                self.log(blue(f"[UPDATE] Updating CI on {ip}"))
-                try:
-                    output = subprocess.run(
-                        [
-                            "ssh",
-                            "-F",
-                            "ssh_config",
-                            "-i",
-                            "id_ed25519",
-                            "-o",
-                            "StrictHostKeyChecking=accept-new",
-                            ip,
-                            f"cd {CI_PATH} && "
-                            f"GITHUB_USERNAME={GITHUB_USERNAME} GITHUB_TOKEN={GITHUB_TOKEN} "
-                            f"GIT_ASKPASS={CI_PATH}/git-askpass.sh "
-                            "git pull --recurse-submodules --ff-only origin main",
-                        ],
-                        timeout=60 * 2,
-                        check=True,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
+        """
+        Update CI on every board, each one as soon as its current job finishes, while
+        the other boards keep taking jobs. Boards that fail to update are quarantined.
+        """
+        try:
+            self.update_boards()
+        except Exception as e:  # noqa: BLE001
+            self.on_error(e, "[UPDATE] Failed to update CI")
+
+    def update_boards(self):
+        with dist_cond:
+            # requests are accepted before the boards are loaded
+            if not state.ready["distribution"]:
+                self.log(blue("[UPDATE] Waiting for the distribution queue to start"))
+                dist_cond.wait_for(lambda: state.ready["distribution"])
+
+        self.set_status("UPDATING")
+        with dist_cond:
+            boards = [ip for ip, status in upload_status.items() if status.connected]
+            for ip, status in upload_status.items():
+                if status.connected:
+                    status.tasks.append(lambda ip=ip: self.update_board(ip))
+                else:
+                    self.log(
+                        red(
+                            f"[UPDATE] Skipping CI update on {ip} because it is disconnected"
+                        )
                     )
-                    self.conn.sendall(output.stdout)
-                    self.conn.sendall(output.stderr)
-                except subprocess.SubprocessError as e:
-                    self.on_error(e, f"[UPDATE] Failed to update CI on {ip}")
+            dist_cond.notify_all()
 
-                    self.status = "FAILED"
-                    return
-            else:
-                self.log(
-                    red(f"[UPDATE] Skipping CI update on {ip} because it is disconnected")
+            self.log(blue(f"[UPDATE] Waiting for {len(boards)} boards to update"))
+            # a board that disconnects before its turn won't run the update
+            dist_cond.wait_for(
+                lambda: all(
+                    ip in self.results or not upload_status[ip].connected for ip in boards
                 )
+            )
 
-        self.log(blue("[UPDATE] CI updates complete"))
-        self.conn.sendall(b"%*&0\n")
-        self.conn.close()
-        self.status = "SUCCESS"
+        self.log(blue("[UPDATE] Summary:"))
+        for ip in boards:
+            result = self.results.get(ip, "DISCONNECTED")
+            self.log((blue if result == "UPDATED" else red)(f"[UPDATE]   {ip}: {result}"))
+
+        if all(self.results.get(ip) == "UPDATED" for ip in boards):
+            self.log(blue("[UPDATE] CI updates complete"))
+            self.finish(0)
+            self.set_status("SUCCESS")
+        else:
+            self.log(red("[UPDATE] CI updates failed on some boards"))
+            self.finish(1)
+            self.set_status("FAILED")
+
+    def update_board(self, ip: str):
+        """
+        Update CI on a board, run by the board's worker between jobs
+        :param ip: The board to update
+        """
+        self.log(blue(f"[UPDATE] Updating CI on {ip}"))
+        prefix = f"[UPDATE {ip}] ".encode()
+        try:
+            # lines of several boards interleave, prefix them with the board
+            with policy.timed("ci_update", ip) as timeout:
+                transport.run(
+                    ip,
+                    f"cd {CI_PATH} && "
+                    f"GITHUB_USERNAME={GITHUB_USERNAME} GITHUB_TOKEN={GITHUB_TOKEN} "
+                    f"GIT_ASKPASS={CI_PATH}/git-askpass.sh "
+                    "git pull --recurse-submodules --ff-only origin main",
+                    timeout,
+                    lambda line: self.send(prefix + line),
+                )
+            result = "UPDATED"
+            # the new CI may flash differently
+            board_state.forget(ip)
+            ci_revision(ip)
+        except subprocess.SubprocessError:
+            self.log(red(f"[UPDATE] Failed to update CI on {ip}, quarantining it"))
+            result = "QUARANTINED"
+
+        with dist_cond:
+            # quarantined boards stop taking jobs until an update succeeds
+            upload_status[ip].quarantined = result != "UPDATED"
+            self.results[ip] = result
+            state.changed()
+            dist_cond.notify_all()
+        push_webhook()
 
 
 @dataclass
 class UploadServerStatus:
+    queue_type: Literal["ATTACK", "TEST"]
     job: DistributionJob | None = None
     connected: bool = True
+    quarantined: bool = False
+    # maintenance to run before the next job, e.g. CI updates
+    tasks: deque[Callable[[], None]] = field(default_factory=deque)
+
+
+def ci_revision(ip: str) -> str | None:
+    """
+    Get the CI revision checked out on a board, recording it for attack_revision
+    :return: The commit hash, None if it could not be read
+    """
+    output = bytearray()
+    try:
+        transport.run(ip, f"git -C {CI_PATH} rev-parse HEAD", 30, output.extend)
+    except subprocess.SubprocessError:
+        revision = None
+    else:
+        revision = output.decode(errors="replace").strip() or None
+    board_state.record_ci_revision(ip, revision)
+    return revision
+
+
+def attack_revision() -> str | None:
+    """
+    Get the CI revision attacks would run with right now
+    :return: The commit hash, None unless it is known and the same on all attack boards
+    """
+    with dist_cond:
+        ips = [
+            ip
+            for ip, stat in upload_status.items()
+            if stat.queue_type == "ATTACK" and stat.connected and not stat.quarantined
+        ]
+    revisions = {board_state.ci_revision(ip) for ip in ips}
+    if len(revisions) != 1 or None in revisions:
+        return None
+    return revisions.pop()
+
+
+def takes(ip: str, job: DistributionJob) -> bool:
+    """
+    Check if a board should run a job, jobs that failed on a board go to the other
+    boards if any are up. Must be called with dist_cond held.
+    """
+    if ip not in job.failed_boards:
+        return True
+    return all(
+        other in job.failed_boards
+        for other, stat in upload_status.items()
+        if stat.queue_type == job.queue_type and stat.connected and not stat.quarantined
+    )
+
+
+def board_loop(ip: str):
+    """
+    Run jobs and maintenance tasks on a board one at a time, until it disconnects
+    :param ip: The board to run jobs on
+    """
+    status = upload_status[ip]
+    queue = distribution_queues[status.queue_type]
+    while True:
+        with dist_cond:
+            dist_cond.wait_for(
+                lambda: (
+                    status.tasks
+                    or (not status.quarantined and any(takes(ip, job) for job in queue))
+                    or not status.connected
+                )
+            )
+            if not status.connected:
+                break
+            if status.tasks:
+                task, req = status.tasks.popleft(), None
+            else:
+                task, req = None, next(job for job in queue if takes(ip, job))
+                queue.remove(req)
+                profiling.record(req.channel, "dist queue", req.start_time)
+                req.set_status("TESTING", time.time())
+                status.job = req
+            state.changed()
 
-    def is_avail(self):
-        return self.connected and (not self.job or self.job.status != "TESTING")
+        try:
+            if task is not None:
+                task()
+                continue
 
+            push_webhook()
+            try:
+                req.distribute(ip)
+            except Exception as e:  # noqa: BLE001
+                req.on_error(e, f"[DIST] Failed to run {req.name} on {ip}")
+                push_webhook(req.queue_type, req)
+        finally:
+            with dist_cond:
+                dist_cond.notify_all()
 
-def distribution_loop():
-    while True:
-        req = distribution_queue.get()
-        avail_ip = server_queues[req.queue_type].get()
-        req.status = "TESTING"
-        req.start_time = time.time()
-        upload_status[avail_ip].job = req
-        push_webhook()
-        threading.Thread(target=req.distribute, args=(avail_ip,), daemon=True).start()
+    print(red(f"[DIST] Stopped scheduling on {ip}"))
 
 
 def add_to_dist_queue(job: DistributionJob):
-    distribution_queue.put(job)
+    with dist_cond:
+        distribution_queues[job.queue_type].append(job)
+        state.changed()
+        dist_cond.notify_all()
 
 
 def init_distribution_queue():
-    # setup ssh
-    with open("ssh_config", "w", encoding="utf-8") as f:
+    # setup ssh, leaving the file alone if nothing changed
+    ssh_config = "".join(
+        f"Host {ip.split('@')[1]}\nProxyCommand cloudflared access ssh --hostname %h\n"
+        for ip, _ in IPS
+    )
+    path = Path("ssh_config")
+    if not path.exists() or path.read_text(encoding="utf-8") != ssh_config:
+        path.write_text(ssh_config, encoding="utf-8")
+    with state.lock:
         for ip, queue_type in IPS:
-            f.write(
-                f"Host {ip.split('@')[1]}\nProxyCommand cloudflared access ssh --hostname %h\n"
-            )
-            upload_status[ip] = UploadServerStatus()
-            server_queues[queue_type].put(ip)
-    push_webhook()
+            upload_status[ip] = UploadServerStatus(queue_type)
+        state.changed()
     print(blue(f"[DIST] Loaded {len(IPS)} ips"))
 
     print(blue("[DIST] Dist queue ready..."))
-    threading.Thread(target=distribution_loop, daemon=True).start()
+    for ip in upload_status:
+        threading.Thread(target=board_loop, args=(ip,), daemon=True).start()
+    with dist_cond:
+        state.set_ready("distribution")
+        # wakes CI updates sent during startup
+        dist_cond.notify_all()
+    push_webhook()
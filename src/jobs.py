@@ -2,9 +2,14 @@ import re
 import subprocess
 import traceback
 from dataclasses import dataclass
-from socket import socket
 
+import capture
+import profiling
+import state
 from colors import red
+from log_channel import LogChannel
+
+ANSI_ESCAPE = re.compile(rb"\x1b\[[0-9;]*m")
 
 
 @dataclass
@@ -25,42 +30,69 @@ class CommitInfo:
 
 @dataclass
 class Job:
-    conn: socket
+    channel: LogChannel
     status: str
     start_time: float
     socket_colors: bool
 
+    @property
+    def id(self):
+        return self.channel.id
+
+    def set_status(self, status: str, start_time: float | None = None):
+        """
+        Update the job's status, which is part of the shared state
+        :param status: The new status
+        :param start_time: When the new status started, if it restarts the job's timer
+        """
+        with state.lock:
+            self.status = status
+            if start_time is not None:
+                self.start_time = start_time
+            state.changed()
+
     def to_json(self):
         return {}
 
     def log(self, msg: str):
         print(msg)
-        if not self.socket_colors:
-            msg = re.sub(r"\x1b\[[0-9;]*m", "", msg)
-        self.conn.sendall(msg.encode() + b"\n")
+        self.send(msg.encode() + b"\n")
+
+    def send(self, data: bytes):
+        if not self.socket_colors and b"\x1b" in data:
+            data = ANSI_ESCAPE.sub(b"", data)
+        self.channel.write(data)
+
+    def finish(self, code: int):
+        self.send(profiling.report(self.channel))
+        self.channel.close(code)
 
     def on_error(self, e: Exception, msg: str):
         self.log(red(msg))
         if isinstance(e, (subprocess.CalledProcessError, subprocess.TimeoutExpired)):
-            self.conn.sendall(e.stdout or b"")
-            self.conn.sendall(e.stderr or b"")
+            # commands stream their output as they run, this is only what was captured
+            output = (e.stdout or b"") + (e.stderr or b"")
+            self.send(capture.truncate(output))
+            if len(output) > capture.REPORT_LIMIT:
+                capture.output_path(self.id).write_bytes(output)
+                self.log(red(f"[CONN] Output truncated, see output {self.id}"))
         self.log(red(traceback.format_exc()))
-        self.conn.sendall(b"%*&1\n")
-        self.conn.close()
-        self.status = "FAILED"
+        self.finish(1)
+        self.set_status("FAILED")
 
 
 class BuildJob(Job):
     commit: CommitInfo
 
-    def __init__(self, conn, status, start_time, commit):
+    def __init__(self, channel, status, start_time, commit):
         self.commit = commit
         super().__init__(
-            conn=conn, status=status, start_time=start_time, socket_colors=True
+            channel=channel, status=status, start_time=start_time, socket_colors=True
         )
 
     def to_json(self):
         return {
+            "id": self.id,
             "result": self.status,
             "actionStart": round(self.start_time),
             "commit": self.commit.to_json(),
@@ -0,0 +1,315 @@
+import contextlib
+import os
+import selectors
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from colors import red
+
+LOG_DIR = Path("./logs")
+RING_SIZE = 1024 * 1024  # bytes of recent output kept in memory per job
+LOG_RETENTION = 60 * 60 * 24  # seconds a finished job can still be reattached to
+READ_CHUNK = 64 * 1024
+COALESCE_WINDOW = 0.05  # seconds to wait for more output before sending
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+STALL_TIMEOUT = 60  # seconds a client can go without reading before it is dropped
+
+channels: dict[str, "LogChannel"] = {}
+channels_lock = threading.Lock()
+last_prune = 0.0
+
+
+class LogChannel:
+    """
+    Output stream of a job. Output is kept in an in-memory ring buffer and a log file,
+    and drained to attached clients by the log pump, so a slow client never blocks
+    the job and a dropped client can reattach and replay from an offset.
+    """
+
+    def __init__(
+        self, conn: socket.socket | None = None, coalesce: float = COALESCE_WINDOW
+    ):
+        self.id = uuid.uuid4().hex
+        LOG_DIR.mkdir(parents=True, exist_ok=True)
+        self.path = LOG_DIR / f"{self.id}.log"
+        self.file = open(self.path, "wb")  # noqa: SIM115
+        # (offset, data) of each write still in memory, kept whole so clients can
+        # send them with sendmsg without copying
+        self.chunks: deque[tuple[int, bytes]] = deque()
+        self.buffer_start = 0  # offset of the first chunk in the log
+        self.size = 0
+        self.coalesce = coalesce
+        self.closed_at: float | None = None
+        self.code: int | None = None
+        self.lock = threading.RLock()
+
+        with channels_lock:
+            _prune()
+            channels[self.id] = self
+
+        if conn is not None:
+            self.attach(conn)
+
+    @property
+    def closed(self):
+        return self.closed_at is not None
+
+    def write(self, data: bytes):
+        """
+        Append output to the log, never blocks on clients
+        :param data: The output to append
+        """
+        if not data:
+            return
+        with self.lock:
+            if self.closed:
+                return
+            self.file.write(data)
+            self.chunks.append((self.size, data))
+            self.size += len(data)
+            while self.size - self.buffer_start > RING_SIZE and len(self.chunks) > 1:
+                self.chunks.popleft()
+                self.buffer_start = self.chunks[0][0]
+        pump.notify(self)
+
+    def close(self, code: int):
+        """
+        Write the final status of the job and end the log
+        :param code: The exit code sent to clients
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.write(f"%*&{code}\n".encode())
+            self.file.close()
+            # finished jobs are kept for reattaching, serve them from the log file
+            self.chunks.clear()
+            self.buffer_start = self.size
+            self.code = code
+            self.closed_at = time.time()
+        pump.notify(self)
+
+    def read(self, offset: int, limit: int = READ_CHUNK) -> list[memoryview]:
+        """
+        Read logged output, from memory if still buffered and from disk otherwise
+        :param offset: The offset in the log to read from
+        :param limit: The maximum number of bytes to read
+        :return: Views of the output, empty if offset is at the end of the log
+        """
+        with self.lock:
+            if offset >= self.buffer_start:
+                # clients are almost always near the end of the log
+                i = max(len(self.chunks) - 1, 0)
+                while i > 0 and self.chunks[i][0] > offset:
+                    i -= 1
+
+                views = []
+                while i < len(self.chunks) and limit > 0 and len(views) < IOV_MAX:
+                    start, data = self.chunks[i]
+                    view = memoryview(data)[offset - start : offset - start + limit]
+                    views.append(view)
+                    offset += len(view)
+                    limit -= len(view)
+                    i += 1
+                return views
+
+            limit = min(limit, self.buffer_start - offset)
+            if not self.file.closed:
+                self.file.flush()
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return [memoryview(f.read(limit))]
+
+    def attach(self, conn: socket.socket, offset: int = 0):
+        """
+        Stream the log to a client, starting from offset
+        :param conn: The client socket, closed once the log ends
+        :param offset: The offset in the log to replay from
+        """
+        pump.add(Subscriber(self, conn, min(offset, self.size)))
+
+
+@dataclass(eq=False)
+class Subscriber:
+    channel: LogChannel
+    conn: socket.socket
+    offset: int
+    last_progress: float = field(default_factory=time.monotonic)
+    send_after: float | None = None  # end of the coalesce window
+    waiting: bool = False  # registered for EVENT_WRITE
+    removed: bool = False
+
+
+class LogPump:
+    """
+    Single thread draining every log channel to its clients with non-blocking
+    sendmsg calls. Small writes are batched within the channel's coalesce window.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.settimeout(0)  # non-blocking
+        self.wake_w.settimeout(0)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+        self.lock = threading.Lock()
+        self.subscribers: dict[LogChannel, set[Subscriber]] = {}
+        self.dirty: set[Subscriber] = set()
+        self.thread: threading.Thread | None = None
+
+    def add(self, sub: Subscriber):
+        sub.conn.settimeout(0)  # non-blocking
+        with self.lock:
+            self.subscribers.setdefault(sub.channel, set()).add(sub)
+            self.dirty.add(sub)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self._wake()
+
+    def notify(self, channel: LogChannel):
+        with self.lock:
+            subs = self.subscribers.get(channel)
+            if not subs:
+                return
+            self.dirty.update(subs)
+        self._wake()
+
+    def _wake(self):
+        # a full socket means it is already woken
+        with contextlib.suppress(BlockingIOError):
+            self.wake_w.send(b"\0")
+
+    def run(self):
+        deferred: set[Subscriber] = set()
+        while True:
+            now = time.monotonic()
+            deadlines = [sub.send_after for sub in deferred if sub.send_after]
+            timeout = max(min(deadlines) - now, 0) if deadlines else 5
+
+            ready = set()
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self.wake_r:
+                    with contextlib.suppress(BlockingIOError):
+                        while self.wake_r.recv(4096):
+                            pass
+                else:
+                    ready.add(key.data)
+            with self.lock:
+                ready |= self.dirty
+                self.dirty.clear()
+                everyone = [sub for subs in self.subscribers.values() for sub in subs]
+
+            now = time.monotonic()
+            ready |= {sub for sub in deferred if sub.send_after <= now}
+            deferred -= ready
+            for sub in ready:
+                if self._flush(sub, now):
+                    deferred.add(sub)
+
+            for sub in everyone:
+                if sub.waiting and now - sub.last_progress > STALL_TIMEOUT:
+                    deferred.discard(sub)
+                    self._remove(sub, detached=True)
+
+    def _flush(self, sub: Subscriber, now: float) -> bool:
+        # returns whether the subscriber is waiting for its coalesce window
+        channel = sub.channel
+        if sub.removed:
+            return False
+        if sub.offset >= channel.size:
+            sub.send_after = None
+            if channel.closed:
+                self._remove(sub)
+            return False
+
+        caught_up = sub.offset + READ_CHUNK > channel.size
+        if channel.coalesce and caught_up and not channel.closed:
+            if sub.send_after is None:
+                sub.send_after = now + channel.coalesce
+            if now < sub.send_after:
+                return True
+        sub.send_after = None
+
+        try:
+            while sub.offset < channel.size:
+                views = channel.read(sub.offset)
+                total = sum(len(view) for view in views)
+                sent = sub.conn.sendmsg(views)
+                sub.offset += sent
+                sub.last_progress = now
+                if sent < total:
+                    self._wait_writable(sub)
+                    return False
+        except BlockingIOError:
+            self._wait_writable(sub)
+            return False
+        except OSError:
+            self._remove(sub, detached=True)
+            return False
+
+        if sub.waiting:
+            self.selector.unregister(sub.conn)
+            sub.waiting = False
+        if channel.closed:
+            self._remove(sub)
+        return False
+
+    def _wait_writable(self, sub: Subscriber):
+        if not sub.waiting:
+            self.selector.register(sub.conn, selectors.EVENT_WRITE, sub)
+            sub.waiting = True
+
+    def _remove(self, sub: Subscriber, *, detached: bool = False):
+        if sub.removed:
+            return
+        sub.removed = True
+        if detached:
+            print(
+                red(
+                    f"[CONN] Client detached from job {sub.channel.id} "
+                    f"at offset {sub.offset}"
+                )
+            )
+        with self.lock:
+            subs = self.subscribers.get(sub.channel, set())
+            subs.discard(sub)
+            if not subs:
+                self.subscribers.pop(sub.channel, None)
+            self.dirty.discard(sub)
+        if sub.waiting:
+            self.selector.unregister(sub.conn)
+            sub.waiting = False
+        sub.conn.close()
+
+
+pump = LogPump()
+
+
+def get_channel(job_id: str) -> LogChannel | None:
+    with channels_lock:
+        return channels.get(job_id)
+
+
+def _prune():
+    # drop logs of jobs that finished too long ago, including ones from before a restart
+    global last_prune  # noqa: PLW0603
+    now = time.time()
+    if now - last_prune < 60:
+        return
+    last_prune = now
+
+    for job_id, channel in list(channels.items()):
+        if channel.closed_at is not None and now - channel.closed_at > LOG_RETENTION:
+            del channels[job_id]
+            channel.path.unlink(missing_ok=True)
+    # logs and traces, named after their job id
+    for path in LOG_DIR.iterdir():
+        job_id = path.name.split(".")[0]
+        if job_id not in channels and now - path.stat().st_mtime > LOG_RETENTION:
+            path.unlink(missing_ok=True)
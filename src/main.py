@@ -1,8 +1,14 @@
+from threading import Thread
+
 from builder import init_build_queue
-from connection import serve
+from connection import listen, serve
 from distribution import init_distribution_queue
 
 if __name__ == "__main__":
-    init_build_queue()
+    # accept requests right away, they wait in the queues until those are started
+    listener = Thread(target=serve, args=(listen(),), daemon=True)
+    listener.start()
+    # boards first, attacks don't need the build setup
     init_distribution_queue()
-    serve()
+    init_build_queue()
+    listener.join()
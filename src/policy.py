@@ -0,0 +1,158 @@
+import json
+import math
+import os
+import subprocess
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+from transport import BoardDisconnectedError
+
+# recent stage durations per board, kept across restarts
+STATS_FILE = Path("./stage_stats.json")
+HISTORY = 50  # durations kept per stage and board
+MIN_SAMPLES = 10  # durations needed before they replace the default timeout
+PERCENTILE = 0.99
+MARGIN = 1.5
+MAX_MOVES = 2  # times a job is moved to another board after a transient failure
+
+# error kinds, see classify
+DISCONNECTED = "DISCONNECTED"
+TRANSIENT = "TRANSIENT"
+FATAL = "FATAL"
+
+TRANSIENT_ERRORS = (
+    b"write error: Broken pipe",
+    b"connection unexpectedly closed",
+    b"Connection reset by peer",
+    b"Connection timed out",
+    b"kex_exchange_identification",
+)
+SSH_ERROR = 255  # exit code of ssh itself failing, rather than the remote command
+
+
+@dataclass
+class Stage:
+    default: float  # timeout until there are enough durations
+    floor: float
+    ceiling: float
+    # a timeout means the board is at fault, not the job
+    board_timeout: bool = False
+
+
+STAGES = {
+    "upload": Stage(30, 15, 120, board_timeout=True),
+    "flash": Stage(60 * 4, 60, 60 * 8, board_timeout=True),
+    "test": Stage(60 * 10, 60 * 2, 60 * 20),
+    "attack": Stage(60 * 10, 60 * 2, 60 * 20),
+    "attack_script": Stage(60 * 10, 60 * 2, 60 * 20),
+    "ci_update": Stage(60 * 2, 30, 60 * 5),
+    "build": Stage(60 * 10, 60 * 2, 60 * 20),
+}
+
+lock = threading.Lock()
+
+
+def _load() -> dict[str, dict[str, list[float]]]:
+    try:
+        with open(STATS_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save():
+    tmp = STATS_FILE.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(durations, f)
+    os.replace(tmp, STATS_FILE)
+
+
+def _percentile(values: list[float]) -> float:
+    values = sorted(values)
+    return values[max(math.ceil(PERCENTILE * len(values)) - 1, 0)]
+
+
+def timeout(stage: str, board: str = "server") -> float:
+    """
+    Get the timeout for a stage, a high percentile of its recent durations on the
+    board plus a margin. Falls back to durations on all boards, then the default.
+    :param stage: The stage, one of STAGES
+    :param board: The board running it
+    :return: The timeout in seconds
+    """
+    limits = STAGES[stage]
+    with lock:
+        samples = durations.get(stage, {})
+        values = samples.get(board, [])
+        if len(values) < MIN_SAMPLES:
+            values = [d for board_values in samples.values() for d in board_values]
+        if len(values) < MIN_SAMPLES:
+            return limits.default
+        return min(max(_percentile(values) * MARGIN, limits.floor), limits.ceiling)
+
+
+def median(stage: str) -> float | None:
+    """
+    Get the typical duration of a stage over all boards
+    :return: The median in seconds, None if the stage has no durations yet
+    """
+    with lock:
+        values = sorted(d for values in durations.get(stage, {}).values() for d in values)
+    return values[len(values) // 2] if values else None
+
+
+def record(stage: str, board: str, duration: float):
+    """
+    Record how long a stage took on a board
+    """
+    with lock:
+        values = durations.setdefault(stage, {}).setdefault(board, [])
+        values.append(round(duration, 3))
+        del values[:-HISTORY]
+        _save()
+
+
+@contextmanager
+def timed(stage: str, board: str = "server") -> Iterator[float]:
+    """
+    Time a stage, yielding its timeout. Durations of stages that failed are not
+    recorded. A timeout of a stage that times out when the board is slow counts as
+    the smaller of the timeout and the default, so a slower board raises its limit
+    up to the default plus the margin, without hangs compounding it further.
+    """
+    limit = timeout(stage, board)
+    start = time.time()
+    try:
+        yield limit
+    except subprocess.TimeoutExpired:
+        if STAGES[stage].board_timeout:
+            record(stage, board, min(limit, STAGES[stage].default))
+        raise
+    record(stage, board, time.time() - start)
+
+
+def classify(e: Exception, stage: str) -> str:
+    """
+    Decide who is at fault for a failed stage
+    :param e: The error
+    :param stage: The stage that failed, one of STAGES
+    :return: DISCONNECTED if the board is gone, TRANSIENT if the job should be
+        retried, possibly on another board, FATAL if the job itself failed
+    """
+    if isinstance(e, BoardDisconnectedError):
+        return DISCONNECTED
+    if isinstance(e, subprocess.TimeoutExpired):
+        return TRANSIENT if STAGES[stage].board_timeout else FATAL
+    if isinstance(e, subprocess.CalledProcessError) and (
+        e.returncode == SSH_ERROR
+        or any(err in (e.stderr or b"") for err in TRANSIENT_ERRORS)
+    ):
+        return TRANSIENT
+    return FATAL
+
+
+durations: dict[str, dict[str, list[float]]] = _load()
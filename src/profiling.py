@@ -0,0 +1,123 @@
+import json
+import os
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+from log_channel import LOG_DIR, LogChannel
+
+
+@dataclass
+class Span:
+    name: str
+    where: str  # the board it ran on, or server
+    start: float
+    wall: float
+    # CPU time of child processes reaped during the span. It is process wide, so
+    # concurrent jobs on other boards add to it, builds are the only exact spans.
+    cpu: float
+    output: int  # bytes of output the job sent during the span
+
+
+# spans of running jobs, by job id
+spans: dict[str, list[Span]] = {}
+lock = threading.Lock()
+
+
+def _child_cpu() -> float:
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+def record(channel: LogChannel, name: str, start: float, where: str = "server"):
+    """
+    Record a span that ends now without timing it, e.g. time spent waiting in a queue
+    :param channel: The job's channel
+    :param name: The step
+    :param start: When the step started
+    :param where: The board it ran on
+    """
+    with lock:
+        spans.setdefault(channel.id, []).append(
+            Span(name, where, start, time.time() - start, 0, 0)
+        )
+
+
+@contextmanager
+def span(channel: LogChannel, name: str, where: str = "server") -> Iterator[None]:
+    """
+    Time a step of a job, including when it fails
+    :param channel: The job's channel
+    :param name: The step
+    :param where: The board it runs on
+    """
+    start, cpu, output = time.time(), _child_cpu(), channel.size
+    try:
+        yield
+    finally:
+        step = Span(
+            name,
+            where,
+            start,
+            time.time() - start,
+            _child_cpu() - cpu,
+            channel.size - output,
+        )
+        with lock:
+            spans.setdefault(channel.id, []).append(step)
+
+
+def trace_path(job_id: str) -> Path:
+    return LOG_DIR / f"{job_id}.trace.json"
+
+
+def write_trace(job_id: str, job_spans: list[Span]):
+    """
+    Write spans as a Chrome trace (chrome://tracing, Perfetto), one row per board
+    """
+    rows = {where: i for i, where in enumerate(dict.fromkeys(s.where for s in job_spans))}
+    events = [
+        {"name": "thread_name", "ph": "M", "pid": 0, "tid": i, "args": {"name": where}}
+        for where, i in rows.items()
+    ]
+    events += [
+        {
+            "name": s.name,
+            "ph": "X",
+            "pid": 0,
+            "tid": rows[s.where],
+            "ts": round(s.start * 1e6),
+            "dur": round(s.wall * 1e6),
+            "args": {"cpu": round(s.cpu, 3), "output": s.output},
+        }
+        for s in job_spans
+    ]
+    tmp = trace_path(job_id).with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    os.replace(tmp, trace_path(job_id))
+
+
+def report(channel: LogChannel) -> bytes:
+    """
+    End profiling of a job, writing its trace file
+    :param channel: The job's channel
+    :return: A timing table of the job's steps, empty if nothing was timed
+    """
+    with lock:
+        job_spans = spans.pop(channel.id, [])
+    if not job_spans:
+        return b""
+    write_trace(channel.id, job_spans)
+
+    lines = [f"{'step':<20}{'where':<24}{'wall':>9}{'cpu':>9}{'output':>10}"]
+    lines.extend(
+        f"{s.name:<20}{s.where:<24}{s.wall:>8.2f}s{s.cpu:>8.2f}s{s.output:>9}B"
+        for s in job_spans
+    )
+    total = max(s.start + s.wall for s in job_spans) - min(s.start for s in job_spans)
+    lines.append(f"{'total':<44}{total:>8.2f}s")
+    return "".join(f"[PROFILE] {line}\n" for line in lines).encode()
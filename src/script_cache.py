@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from urllib.parse import urlparse
+
+import requests
+
+CACHE_DIR = Path("./script_cache")
+CACHE_LIMIT = 64 * 1024 * 1024  # total bytes kept on disk
+MAX_SCRIPT_SIZE = 4 * 1024 * 1024
+FETCH_TIMEOUT = 5
+
+cache_lock = threading.Lock()
+
+
+class ScriptFetchError(Exception):
+    pass
+
+
+@dataclass
+class CacheEntry:
+    url: str
+    etag: str | None
+    last_modified: str | None
+    size: int
+    fresh_until: float
+    last_used: float
+
+    @property
+    def path(self) -> Path:
+        return CACHE_DIR / hashlib.sha256(self.url.encode()).hexdigest()
+
+
+@dataclass
+class Script:
+    url: str
+    filename: str
+    content: bytes
+    stale: bool = False
+
+
+def script_filename(url: str) -> str:
+    """
+    Get the name the script at url will be uploaded as
+    :param url: The script url
+    :return: The filename, or "" if the url does not name a file
+    """
+    return urlparse(url).path.split("/")[-1]
+
+
+def _load_index() -> dict[str, CacheEntry]:
+    try:
+        with open(CACHE_DIR / "index.json", encoding="utf-8") as f:
+            return {url: CacheEntry(**entry) for url, entry in json.load(f).items()}
+    except (OSError, ValueError, TypeError):
+        return {}
+
+
+def _save_index():
+    # replaced whole, a crash mid-write would orphan every cached script
+    tmp = CACHE_DIR / "index.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({url: asdict(entry) for url, entry in index.items()}, f)
+    os.replace(tmp, CACHE_DIR / "index.json")
+
+
+def _max_age(resp: requests.Response) -> float:
+    cache_control = resp.headers.get("Cache-Control", "")
+    if "no-cache" in cache_control:
+        return 0
+    match = re.search(r"max-age=(\d+)", cache_control)
+    return int(match.group(1)) if match else 0
+
+
+def _evict():
+    # drop least recently used scripts until under the size limit
+    total = sum(entry.size for entry in index.values())
+    for entry in sorted(index.values(), key=lambda entry: entry.last_used):
+        if total <= CACHE_LIMIT:
+            break
+        entry.path.unlink(missing_ok=True)
+        del index[entry.url]
+        total -= entry.size
+
+
+def _read_limited(resp: requests.Response) -> bytes:
+    if int(resp.headers.get("Content-Length") or 0) > MAX_SCRIPT_SIZE:
+        raise ScriptFetchError(f"Script is larger than {MAX_SCRIPT_SIZE} bytes")
+
+    content = bytearray()
+    for chunk in resp.iter_content(64 * 1024):
+        content += chunk
+        if len(content) > MAX_SCRIPT_SIZE:
+            raise ScriptFetchError(f"Script is larger than {MAX_SCRIPT_SIZE} bytes")
+    return bytes(content)
+
+
+def _lookup(url: str) -> tuple[CacheEntry | None, bytes]:
+    # read now, another fetch may evict it while this one waits on the host
+    with cache_lock:
+        entry = index.get(url)
+        if entry is None:
+            return None, b""
+        try:
+            content = entry.path.read_bytes()
+        except OSError:
+            del index[url]
+            return None, b""
+        entry.last_used = time.time()
+        return entry, content
+
+
+def _conditional_headers(entry: CacheEntry | None) -> dict[str, str]:
+    headers = {}
+    if entry is not None:
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+    return headers
+
+
+def _store(url: str, resp: requests.Response, now: float) -> bytes:
+    content = _read_limited(resp)
+    if "no-store" in resp.headers.get("Cache-Control", ""):
+        return content
+
+    entry = CacheEntry(
+        url=url,
+        etag=resp.headers.get("ETag"),
+        last_modified=resp.headers.get("Last-Modified"),
+        size=len(content),
+        fresh_until=now + _max_age(resp),
+        last_used=now,
+    )
+    with cache_lock:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        entry.path.write_bytes(content)
+        index[url] = entry
+        _evict()
+        _save_index()
+    return content
+
+
+def fetch_script(url: str) -> Script:
+    """
+    Fetch an attack script, revalidating any cached copy with
+    If-None-Match/If-Modified-Since instead of downloading it again
+    :param url: The script url
+    :return: The script contents
+    :raises ScriptFetchError: If the script could not be fetched and is not cached
+    """
+    filename = script_filename(url)
+    # the lock only guards the index, fetches run concurrently
+    entry, cached = _lookup(url)
+    now = time.time()
+    if entry is not None and now < entry.fresh_until:
+        return Script(url, filename, cached)
+
+    try:
+        with requests.get(
+            url, headers=_conditional_headers(entry), timeout=FETCH_TIMEOUT, stream=True
+        ) as resp:
+            if resp.status_code == 304 and entry is not None:
+                with cache_lock:
+                    entry.fresh_until = now + _max_age(resp)
+                    _save_index()
+                return Script(url, filename, cached)
+
+            if not resp.ok:
+                raise ScriptFetchError(f"Fetching {url} returned {resp.status_code}")
+            return Script(url, filename, _store(url, resp, now))
+    except requests.RequestException as e:
+        if entry is None:
+            raise ScriptFetchError(f"Fetching {url} failed: {e}") from e
+        # host is down or slow, fall back to the copy we already have
+        return Script(url, filename, cached, stale=True)
+
+
+index: dict[str, CacheEntry] = _load_index()
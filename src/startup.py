@@ -0,0 +1,52 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from board_state import digest
+
+# fingerprints of what each startup step last ran against, so restarts can skip them
+STATE_FILE = Path("./startup_state.json")
+
+
+def _load() -> dict[str, str]:
+    try:
+        with open(STATE_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def fingerprint(*parts: str | Path) -> str:
+    """
+    Hash what a startup step depends on
+    :param parts: Strings, and files or directories which are hashed by content
+    :return: The hex digest
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, Path):
+            h.update(digest(part).encode() if part.exists() else b"missing")
+        else:
+            h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def unchanged(step: str, fp: str) -> bool:
+    """
+    Check if a step already ran against the same inputs
+    """
+    return _load().get(step) == fp
+
+
+def record(step: str, fp: str):
+    """
+    Record that a step ran successfully
+    """
+    steps = _load()
+    steps[step] = fp
+    tmp = STATE_FILE.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(steps, f)
+    os.replace(tmp, STATE_FILE)
@@ -0,0 +1,75 @@
+import threading
+
+# guards every piece of scheduler state shared between threads (build queue, active
+# build, distribution queues, board status, job status). Writers hold it while
+# mutating and call changed(), readers use snapshot().
+lock = threading.RLock()
+version = 0
+# parts of the server that finished starting, requests are queued until they are
+ready = {"build": False, "distribution": False}
+# (version, snapshot) of the last snapshot, replaced as a whole so readers never lock
+_cache: tuple[int, dict] = (-1, {})
+
+
+def changed():
+    """
+    Mark the shared state as modified, must be called with lock held
+    """
+    global version  # noqa: PLW0603
+    version += 1
+
+
+def set_ready(part: str):
+    """
+    Mark a part of the server as started
+    :param part: A key of ready
+    """
+    with lock:
+        ready[part] = True
+        changed()
+
+
+def snapshot() -> dict:
+    """
+    Get a consistent view of the shared state. Snapshots are rebuilt at most once
+    per version and must not be mutated by readers.
+    :return: The snapshot
+    """
+    global _cache  # noqa: PLW0603
+    cached_version, cached = _cache
+    if cached_version == version:
+        return cached
+
+    import builder  # noqa: PLC0415
+    from distribution import distribution_queues, upload_status  # noqa: PLC0415
+
+    with lock:
+        active_build = builder.active_build
+        cached = {
+            "version": version,
+            "ready": dict(ready),
+            "build": {
+                "active": active_build.to_json() if active_build else None,
+                "queue": [job.to_json() for job in builder.pending_builds],
+            },
+            "test": {
+                "activeTests": [
+                    {
+                        "ip": ip,
+                        # TODO rename field
+                        "locked": not stat.connected or stat.quarantined,
+                        "active": stat.job.to_json() if stat.job else None,
+                    }
+                    for ip, stat in upload_status.items()
+                ],
+                "queue": [
+                    job.to_json()
+                    for job in sorted(
+                        (job for queue in distribution_queues.values() for job in queue),
+                        key=lambda job: job.start_time,
+                    )
+                ],
+            },
+        }
+        _cache = (version, cached)
+        return cached
@@ -0,0 +1,311 @@
+import io
+import json
+import os
+import shutil
+import signal
+import struct
+import subprocess
+import tarfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Callable, Sequence
+from pathlib import Path
+
+from board_agent import read_frame, write_frame
+from colors import red
+
+SSH = [
+    "ssh",
+    "-F",
+    "ssh_config",
+    "-i",
+    "id_ed25519",
+    "-o",
+    "StrictHostKeyChecking=accept-new",
+]
+AGENT_PATH = "~/ectf2025/agent/"
+# most output passed on at once, so a line without newlines is never buffered whole
+READ_CHUNK = 64 * 1024
+
+OutputCallback = Callable[[bytes], None]
+
+
+class BoardDisconnectedError(subprocess.CalledProcessError):
+    """
+    The board could not be reached, the job should be moved to another board
+    """
+
+
+def stream_process(
+    argv: Sequence[str] | str,
+    timeout: float | None,
+    on_output: OutputCallback,
+    **kwargs,
+) -> int:
+    """
+    Run a process, passing its combined stdout and stderr to on_output as it arrives,
+    so none of it is held in memory
+    :param argv: The command to run
+    :param timeout: Seconds before the process is killed
+    :param on_output: Called with each line, or READ_CHUNK bytes of a longer line
+    :return: The exit code
+    :raises subprocess.TimeoutExpired: If the process timed out
+    """
+    with subprocess.Popen(
+        argv,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        # its own process group, so a timeout kills everything a shell started
+        start_new_session=True,
+        **kwargs,
+    ) as proc:
+
+        def reader():
+            while line := proc.stdout.readline(READ_CHUNK):
+                on_output(line)
+
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+        try:
+            code = proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+            raise
+        finally:
+            thread.join()
+    return code
+
+
+class Transport(ABC):
+    """
+    How the server talks to boards
+    """
+
+    @abstractmethod
+    def upload(self, ip: str, files: Sequence[Path | str], out_path: str, timeout: float):
+        """
+        Copy files and directories into out_path on a board
+        :raises subprocess.CalledProcessError: If the upload failed, with stderr set
+        :raises subprocess.TimeoutExpired: If the upload timed out
+        """
+
+    @abstractmethod
+    def run(self, ip: str, command: str, timeout: float, on_output: OutputCallback):
+        """
+        Run a shell command on a board, streaming its output
+        :raises subprocess.CalledProcessError: If the command failed
+        :raises subprocess.TimeoutExpired: If the command timed out
+        """
+
+    def check(self, ip: str) -> bool:
+        """
+        Check that a board is reachable
+        """
+        try:
+            self.run(ip, "true", 30, lambda _: None)
+        except subprocess.SubprocessError:
+            return False
+        return True
+
+
+class SSHTransport(Transport):
+    """
+    ssh and rsync through cloudflared, one process and handshake per command
+    """
+
+    def upload(self, ip: str, files: Sequence[Path | str], out_path: str, timeout: float):
+        try:
+            subprocess.run(
+                [
+                    "rsync",
+                    (
+                        "--rsh=ssh -F ssh_config -i id_ed25519 -o StrictHostKeyChecking=accept-new"
+                        " -o ServerAliveInterval=5 -o ServerAliveCountMax=1"
+                    ),
+                    "-avz",
+                    # rsync sends a delta against what is already on the board, and
+                    # a retry after a dropped tunnel picks up the partial file
+                    "--partial-dir=.rsync-partial",
+                    "--progress",
+                    "--delete",
+                    *files,
+                    f"{ip}:{out_path}",
+                ],
+                timeout=timeout,
+                check=True,
+                # only stderr is needed to tell why an upload failed
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+        except subprocess.CalledProcessError as e:
+            if b"Connection closed by UNKNOWN port 65535" in e.stderr:
+                raise BoardDisconnectedError(
+                    e.returncode, e.cmd, e.output, e.stderr
+                ) from e
+            raise
+
+    def run(self, ip: str, command: str, timeout: float, on_output: OutputCallback):
+        argv = [*SSH, ip, command]
+        code = stream_process(argv, timeout, on_output)
+        if code != 0:
+            raise subprocess.CalledProcessError(code, argv)
+
+
+class AgentTransport(SSHTransport):
+    """
+    Persistent agent (board_agent.py) on each board, reached over one long-lived ssh
+    connection that all commands and uploads are framed over
+    """
+
+    def __init__(self):
+        self.agents: dict[str, subprocess.Popen] = {}
+        self.locks: dict[str, threading.Lock] = {}
+        self.lock = threading.Lock()
+
+    def _board_lock(self, ip: str) -> threading.Lock:
+        with self.lock:
+            return self.locks.setdefault(ip, threading.Lock())
+
+    def _agent(self, ip: str) -> subprocess.Popen:
+        agent = self.agents.get(ip)
+        if agent is not None and agent.poll() is None:
+            return agent
+
+        # (re)deploy the agent, it is small enough to send every time it starts
+        super().upload(ip, [Path(__file__).parent / "board_agent.py"], AGENT_PATH, 30)
+        agent = subprocess.Popen(
+            [
+                *SSH,
+                "-o",
+                "ServerAliveInterval=5",
+                "-o",
+                "ServerAliveCountMax=3",
+                ip,
+                f"python3 {AGENT_PATH}/board_agent.py",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self.agents[ip] = agent
+        return agent
+
+    def _request(
+        self,
+        ip: str,
+        kind: bytes,
+        payload: bytes,
+        timeout: float,
+        on_output: OutputCallback,
+    ) -> dict:
+        with self._board_lock(ip):
+            agent = self._agent(ip)
+            # the agent enforces the timeout, this only catches a hung connection
+            watchdog = threading.Timer(timeout + 30, agent.kill)
+            watchdog.start()
+            try:
+                write_frame(agent.stdin, kind, payload)
+                while (frame := read_frame(agent.stdout)) is not None:
+                    frame_kind, data = frame
+                    if frame_kind == b"O":
+                        on_output(data)
+                    elif frame_kind == b"X":
+                        return json.loads(data)
+            except (OSError, ValueError):
+                pass
+            finally:
+                watchdog.cancel()
+
+            print(red(f"[DIST] Lost agent connection to {ip}"))
+            agent.kill()
+            del self.agents[ip]
+            raise BoardDisconnectedError(
+                255, ["board_agent", ip], stderr=b"Lost connection to board agent"
+            )
+
+    def upload(self, ip: str, files: Sequence[Path | str], out_path: str, timeout: float):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+            for file in files:
+                tar.add(file, arcname=Path(file).name)
+        header = json.dumps({"out_path": out_path}).encode()
+        payload = struct.pack(">I", len(header)) + header + buf.getvalue()
+
+        output = bytearray()
+        result = self._request(ip, b"U", payload, timeout, output.extend)
+        if result["code"] != 0:
+            raise subprocess.CalledProcessError(
+                result["code"], ["upload", out_path], stderr=bytes(output)
+            )
+
+    def run(self, ip: str, command: str, timeout: float, on_output: OutputCallback):
+        payload = json.dumps({"cmd": command, "timeout": timeout}).encode()
+        result = self._request(ip, b"R", payload, timeout, on_output)
+        if result["timed_out"]:
+            raise subprocess.TimeoutExpired(command, timeout)
+        if result["code"] != 0:
+            raise subprocess.CalledProcessError(result["code"], command)
+
+    def check(self, ip: str) -> bool:
+        try:
+            return self._request(ip, b"P", b"", 30, lambda _: None)["code"] == 0
+        except subprocess.SubprocessError:
+            return False
+
+
+class LocalTransport(Transport):
+    """
+    Boards simulated by local directories, <root>/<host> acting as the board's home
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def _home(self, ip: str) -> Path:
+        home = self.root / ip.rsplit("@", maxsplit=1)[-1]
+        if not home.is_dir():
+            raise BoardDisconnectedError(
+                255, ["local", ip], stderr=f"No board at {home}".encode()
+            )
+        return home
+
+    def upload(self, ip: str, files: Sequence[Path | str], out_path: str, timeout: float):
+        out = self._home(ip) / out_path.removeprefix("~/")
+        out.mkdir(parents=True, exist_ok=True)
+        deadline = time.monotonic() + timeout
+        for file in files:
+            # checked between files, a local copy can't hang
+            if time.monotonic() > deadline:
+                raise subprocess.TimeoutExpired(["upload", out_path], timeout)
+            path = Path(file)
+            if path.is_dir():
+                # replaced like rsync --delete, files removed since the last upload go
+                shutil.rmtree(out / path.name, ignore_errors=True)
+                shutil.copytree(path, out / path.name)
+            else:
+                shutil.copy2(path, out / path.name)
+
+    def run(self, ip: str, command: str, timeout: float, on_output: OutputCallback):
+        home = self._home(ip)
+        argv = ["bash", "-c", command]
+        env = {**os.environ, "HOME": str(home)}
+        code = stream_process(argv, timeout, on_output, cwd=home, env=env)
+        if code != 0:
+            raise subprocess.CalledProcessError(code, argv)
+
+
+def make_transport() -> Transport:
+    kind = os.getenv("BOARD_TRANSPORT", "ssh")
+    if kind == "ssh":
+        return SSHTransport()
+    if kind == "agent":
+        return AgentTransport()
+    if kind == "local":
+        return LocalTransport(Path(os.environ["LOCAL_BOARDS"]))
+    raise ValueError(f"Unknown board transport {kind}")
+
+
+transport = make_transport()
@@ -1,56 +1,67 @@
+import threading
 import traceback
 
 import requests
 
+import state
 from colors import red
 from config import DEBUG, WEBHOOK_IP
 from jobs import Job
 
 active_status: Job | None = None
+# posts are sent by a single thread, so callers never wait on the network. Only the
+# latest payload is kept, each carries the whole state, so a slow or down webhook
+# host delays the dashboard by one post instead of a growing backlog.
+pending: dict | None = None
+pending_cond = threading.Condition()
+sender: threading.Thread | None = None
 
 
 def push_webhook(update_type: str = "QUEUE", update_state: Job | None = None):
-    from builder import BUILD_QUEUE, active_build  # noqa: PLC0415
-    from distribution import distribution_queue, upload_status  # noqa: PLC0415
+    global active_status, pending, sender  # noqa: PLW0603
 
     if DEBUG:  # disable webhook while debugging
         return
 
-    if update_state is not None:
-        global active_status
-        active_status = update_state
-    try:
-        requests.post(
-            WEBHOOK_IP,
-            json={
-                "update": {
-                    "type": update_type,
-                    "state": update_state.to_json() if update_state else None,
-                },
-                "status": active_status.status if active_status else None,
-                "build": {
-                    "active": active_build.to_json() if active_build else None,
-                    "queue": [
-                        action.to_json() for action in list(BUILD_QUEUE.queue)
-                    ],  # allegedly safe (https://stackoverflow.com/a/8196904)
-                },
-                "test": {
-                    "activeTests": [
-                        {
-                            "ip": ip,
-                            "locked": not stat.connected,  # TODO rename field
-                            "active": stat.job.to_json() if stat.job else None,
-                        }
-                        for ip, stat in upload_status.items()
-                    ],
-                    "queue": [
-                        action.to_json() for action in list(distribution_queue.queue)
-                    ],
-                },
+    with state.lock:
+        if update_state is not None:
+            active_status = update_state
+        payload = {
+            "update": {
+                "type": update_type,
+                "state": update_state.to_json() if update_state else None,
             },
-            headers={"content-type": "application/json"},
-            timeout=15,
-        )
-    except requests.RequestException as e:
-        print(red("[WEBHOOK] Could not push webhook"))
-        traceback.print_exc()
+            "status": active_status.status if active_status else None,
+            **state.snapshot(),
+        }
+
+        if sender is None:
+            sender = threading.Thread(target=webhook_loop, daemon=True)
+            sender.start()
+        # still under the state lock, so an older snapshot can't replace a newer one
+        with pending_cond:
+            pending = payload
+            pending_cond.notify()
+
+
+def next_payload() -> dict:
+    global pending
+    with pending_cond:
+        pending_cond.wait_for(lambda: pending is not None)
+        payload, pending = pending, None
+    return payload
+
+
+def webhook_loop():
+    while True:
+        payload = next_payload()
+        try:
+            requests.post(
+                WEBHOOK_IP,
+                json=payload,
+                headers={"content-type": "application/json"},
+                timeout=15,
+            )
+        except requests.RequestException:
+            print(red("[WEBHOOK] Could not push webhook"))
+            traceback.print_exc()